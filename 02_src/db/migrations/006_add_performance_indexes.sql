@@ -0,0 +1,17 @@
+-- Migration: ホットクエリ用の複合インデックス追加
+-- 未完了タスク一覧・会話履歴の取得をソートなしのインデックス範囲スキャンで処理する
+--
+-- 注意: CREATE INDEX CONCURRENTLY はトランザクション内で実行できないため、
+--       1文ずつ実行すること
+-- users(line_user_id) は init.sql の UNIQUE 制約で一意インデックスが作成済み
+
+-- 未完了タスクの取得（WHERE user_id = ? AND is_deleted = false AND status = 'pending' ORDER BY due_date）
+-- is_deleted は部分インデックスの条件に含まれるためキーから外し、id を INCLUDE して
+-- タスク詳細表示の順番計算（SELECT id ... ORDER BY due_date）をインデックスオンリースキャンで処理する
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tasks_user_status_due
+ON tasks (user_id, status, due_date) INCLUDE (id)
+WHERE is_deleted = false;
+
+-- 直近の会話履歴の取得（WHERE user_id = ? ORDER BY created_at DESC LIMIT n）
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_conversation_history_user_created
+ON conversation_history (user_id, created_at DESC);
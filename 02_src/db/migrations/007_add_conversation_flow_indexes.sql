@@ -0,0 +1,17 @@
+-- Migration: 会話フロー状態（systemメッセージ）の検索用インデックス追加
+-- タスク追加・プロフィール編集・メモ編集のフラグ参照/削除をインデックス範囲スキャンで処理する
+--
+-- 注意: CREATE INDEX CONCURRENTLY はトランザクション内で実行できないため、
+--       1文ずつ実行すること
+-- 直近の会話履歴（WHERE user_id = ? ORDER BY created_at DESC LIMIT n）は
+-- 006 の idx_conversation_history_user_created で対応済み
+-- systemメッセージは会話履歴のごく一部のため、部分インデックスにして書き込み負荷を抑える
+-- フラグの前方一致検索・削除（message LIKE 'editing:%' 等）も下記インデックスで
+-- ユーザーごとの数行に絞り込めるため、message 列にはインデックスを作成しない
+-- （message にはユーザー入力が含まれ、長文だとBツリーのインデックス行サイズ上限を超えて INSERT が失敗する）
+
+-- 最新のフロー状態の取得（WHERE user_id = ? AND role = 'system' ORDER BY created_at DESC LIMIT 1）
+-- およびフロー状態フラグの検索・削除（WHERE user_id = ? AND role = 'system' AND message LIKE 'editing:%'）
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_conversation_history_system_created
+ON conversation_history (user_id, created_at DESC)
+WHERE role = 'system';
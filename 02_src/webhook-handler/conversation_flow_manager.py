@@ -10,6 +10,70 @@ import sqlalchemy
 from datetime import datetime, timedelta
 import json
 
+# SQL文（インスタンス生成・呼び出しごとに構築しないようモジュール読み込み時に構築）
+_SQL_GET_CURRENT_STATE = sqlalchemy.text(
+    """
+    SELECT state_name, state_data, expires_at
+    FROM conversation_states
+    WHERE user_id = :user_id
+    ORDER BY updated_at DESC
+    LIMIT 1
+    """
+)
+_SQL_UPSERT_STATE = sqlalchemy.text(
+    """
+    INSERT INTO conversation_states (user_id, state_name, state_data, expires_at)
+    VALUES (:user_id, :state_name, :state_data, :expires_at)
+    ON CONFLICT (user_id, state_name)
+    DO UPDATE SET
+        state_data = EXCLUDED.state_data,
+        expires_at = EXCLUDED.expires_at,
+        updated_at = CURRENT_TIMESTAMP
+    """
+)
+_SQL_GET_STATE_DATA = sqlalchemy.text(
+    """
+    SELECT state_data FROM conversation_states
+    WHERE user_id = :user_id AND state_name = :state_name
+    """
+)
+_SQL_DELETE_STATE = sqlalchemy.text(
+    """
+    DELETE FROM conversation_states
+    WHERE user_id = :user_id AND state_name = :state_name
+    """
+)
+_SQL_DELETE_ALL_STATES = sqlalchemy.text(
+    """
+    DELETE FROM conversation_states
+    WHERE user_id = :user_id
+    """
+)
+_SQL_GET_LATEST_STEP_STATUS = sqlalchemy.text(
+    """
+    SELECT status FROM task_generation_steps
+    WHERE user_id = :user_id AND step_name = :step_name
+    ORDER BY created_at DESC
+    LIMIT 1
+    """
+)
+_SQL_GET_LATEST_STEP_ID = sqlalchemy.text(
+    """
+    SELECT id FROM task_generation_steps
+    WHERE user_id = :user_id AND step_name = :step_name
+    ORDER BY created_at DESC
+    LIMIT 1
+    """
+)
+_SQL_INSERT_STEP = sqlalchemy.text(
+    """
+    INSERT INTO task_generation_steps
+    (user_id, step_name, status, started_at, completed_at, metadata, error_message)
+    VALUES
+    (:user_id, :step_name, :status, :started_at, :completed_at, :metadata, :error_message)
+    """
+)
+
 
 class ConversationState:
     """会話状態の定義"""
@@ -41,15 +105,7 @@ class ConversationFlowManager:
         """
 
         result = self.conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT state_name, state_data, expires_at
-                FROM conversation_states
-                WHERE user_id = :user_id
-                ORDER BY updated_at DESC
-                LIMIT 1
-                """
-            ),
+            _SQL_GET_CURRENT_STATE,
             {'user_id': user_id}
         ).fetchone()
 
@@ -85,17 +141,7 @@ class ConversationFlowManager:
 
         # 既存の状態を更新または新規作成
         self.conn.execute(
-            sqlalchemy.text(
-                """
-                INSERT INTO conversation_states (user_id, state_name, state_data, expires_at)
-                VALUES (:user_id, :state_name, :state_data, :expires_at)
-                ON CONFLICT (user_id, state_name)
-                DO UPDATE SET
-                    state_data = EXCLUDED.state_data,
-                    expires_at = EXCLUDED.expires_at,
-                    updated_at = CURRENT_TIMESTAMP
-                """
-            ),
+            _SQL_UPSERT_STATE,
             {
                 'user_id': user_id,
                 'state_name': state_name,
@@ -119,12 +165,7 @@ class ConversationFlowManager:
         """
 
         result = self.conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT state_data FROM conversation_states
-                WHERE user_id = :user_id AND state_name = :state_name
-                """
-            ),
+            _SQL_GET_STATE_DATA,
             {'user_id': user_id, 'state_name': state_name}
         ).fetchone()
 
@@ -144,22 +185,12 @@ class ConversationFlowManager:
 
         if state_name:
             self.conn.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM conversation_states
-                    WHERE user_id = :user_id AND state_name = :state_name
-                    """
-                ),
+                _SQL_DELETE_STATE,
                 {'user_id': user_id, 'state_name': state_name}
             )
         else:
             self.conn.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM conversation_states
-                    WHERE user_id = :user_id
-                    """
-                ),
+                _SQL_DELETE_ALL_STATES,
                 {'user_id': user_id}
             )
 
@@ -178,14 +209,7 @@ class ConversationFlowManager:
         """
 
         result = self.conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT status FROM task_generation_steps
-                WHERE user_id = :user_id AND step_name = :step_name
-                ORDER BY created_at DESC
-                LIMIT 1
-                """
-            ),
+            _SQL_GET_LATEST_STEP_STATUS,
             {'user_id': user_id, 'step_name': step_name}
         ).fetchone()
 
@@ -212,14 +236,7 @@ class ConversationFlowManager:
 
         # 既存のレコードを探す
         existing = self.conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT id FROM task_generation_steps
-                WHERE user_id = :user_id AND step_name = :step_name
-                ORDER BY created_at DESC
-                LIMIT 1
-                """
-            ),
+            _SQL_GET_LATEST_STEP_ID,
             {'user_id': user_id, 'step_name': step_name}
         ).fetchone()
 
@@ -265,14 +282,7 @@ class ConversationFlowManager:
                 insert_data['completed_at'] = datetime.now()
 
             self.conn.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO task_generation_steps
-                    (user_id, step_name, status, started_at, completed_at, metadata, error_message)
-                    VALUES
-                    (:user_id, :step_name, :status, :started_at, :completed_at, :metadata, :error_message)
-                    """
-                ),
+                _SQL_INSERT_STEP,
                 {
                     'user_id': insert_data['user_id'],
                     'step_name': insert_data['step_name'],
@@ -25,4 +25,8 @@ def validate_signature(body: str, signature: str, channel_secret: str) -> bool:
         hashlib.sha256
     ).digest()
     calculated_signature = base64.b64encode(hash_value).decode('utf-8')
-    return calculated_signature == signature
+    # 一致した長さがタイミングで漏れないよう定数時間で比較する
+    return hmac.compare_digest(
+        calculated_signature.encode('utf-8'),
+        signature.encode('utf-8')
+    )
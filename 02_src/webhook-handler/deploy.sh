@@ -7,6 +7,11 @@ PROJECT_ID="uketsuguai-dev"
 REGION="asia-northeast1"
 FUNCTION_NAME="webhook-handler"
 
+# 1インスタンスあたりの同時リクエスト数（I/O待ちの間に他のイベントを処理する）
+# main.py のDB接続プールの pool_size と同じ値にすること
+# （max_overflow の追加接続はLINE返信後のバックグラウンド処理用に残しておく）
+CONCURRENCY=15
+
 echo "Deploying Cloud Function: ${FUNCTION_NAME}"
 echo "Project: ${PROJECT_ID}"
 echo "Region: ${REGION}"
@@ -22,6 +27,8 @@ gcloud functions deploy ${FUNCTION_NAME} \
   --env-vars-file=.env.yaml \
   --service-account=webhook-handler@${PROJECT_ID}.iam.gserviceaccount.com \
   --memory=512Mi \
+  --cpu=1 \
+  --concurrency=${CONCURRENCY} \
   --timeout=60s \
   --max-instances=10
 
@@ -2,6 +2,7 @@
 行政手続きナレッジベース
 主要な死後手続きに関する情報を構造化して保持
 """
+from functools import lru_cache
 
 # 手続き情報のナレッジベース
 KNOWLEDGE_BASE = {
@@ -104,6 +105,15 @@ KNOWLEDGE_BASE = {
     },
 }
 
+# 手続きごとの (キーワード, 整形済みテキスト)（ナレッジベースは静的なので起動時に一度だけ整形）
+_KNOWLEDGE_SECTIONS = tuple(
+    (tuple(data["keywords"]), f"【{topic}】\n{data['content']}")
+    for topic, data in KNOWLEDGE_BASE.items()
+)
+
+# 全知識のテキスト
+_ALL_KNOWLEDGE = "\n\n".join(section for _, section in _KNOWLEDGE_SECTIONS)
+
 
 def search_knowledge(query: str) -> str:
     """
@@ -115,18 +125,20 @@ def search_knowledge(query: str) -> str:
     Returns:
         関連する知識のテキスト
     """
-    query_lower = query.lower()
-    relevant_knowledge = []
+    # 同じ質問が繰り返されることが多いため、正規化したクエリ単位で結果をキャッシュ
+    return _search_knowledge_normalized(query.strip().lower())
 
-    for topic, data in KNOWLEDGE_BASE.items():
-        # キーワードマッチング
-        if any(keyword in query_lower for keyword in data["keywords"]):
-            relevant_knowledge.append(f"【{topic}】\n{data['content']}")
 
-    if relevant_knowledge:
-        return "\n\n".join(relevant_knowledge)
-    else:
-        return ""
+@lru_cache(maxsize=1024)
+def _search_knowledge_normalized(query_lower: str) -> str:
+    """正規化済みクエリでナレッジベースを検索"""
+    relevant_knowledge = [
+        section
+        for keywords, section in _KNOWLEDGE_SECTIONS
+        # キーワードマッチング
+        if any(keyword in query_lower for keyword in keywords)
+    ]
+    return "\n\n".join(relevant_knowledge)
 
 
 def get_all_knowledge() -> str:
@@ -136,8 +148,4 @@ def get_all_knowledge() -> str:
     Returns:
         全知識のテキスト
     """
-    all_content = []
-    for topic, data in KNOWLEDGE_BASE.items():
-        all_content.append(f"【{topic}】\n{data['content']}")
-
-    return "\n\n".join(all_content)
+    return _ALL_KNOWLEDGE
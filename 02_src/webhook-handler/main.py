@@ -1,8 +1,12 @@
 import os
+import re
 import json
-import hmac
-import hashlib
-import base64
+import logging
+import threading
+import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import parse_qsl
 import functions_framework
 from flask import Request, jsonify, abort
 from linebot.v3 import WebhookHandler
@@ -30,11 +34,12 @@ from linebot.v3.webhooks import (
 from google.cloud import secretmanager
 from google.cloud.sql.connector import Connector
 from google.cloud import tasks_v2
+from google.api_core.exceptions import AlreadyExists
 import sqlalchemy
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 from google import genai
 from google.genai import types
-from flex_messages import create_task_list_flex, create_task_completed_flex
+from flex_messages import create_task_list_flex, create_task_completed_flex, create_task_detail_flex
 from knowledge_base import search_knowledge
 from question_generator import (
     generate_follow_up_questions,
@@ -45,6 +50,7 @@ from question_generator import (
     format_question_for_line
 )
 from conversation_flow_manager import ConversationFlowManager, ConversationState
+from task_generator import generate_basic_tasks, get_task_summary_message
 from task_personalizer import generate_personalized_tasks
 from task_enhancer import enhance_tasks_with_tips, generate_general_tips_task
 from rate_limiter import is_rate_limited
@@ -53,22 +59,374 @@ from plan_controller import PlanController
 from auth_utils import verify_user_ownership, AuthorizationError
 from pay_it_forward_manager import get_pay_it_forward_manager
 
+# ログ設定（%形式の遅延フォーマットで、出力されないレベルの文字列生成を省く）
+logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# メッセージコマンド（別名は読み込み時に展開し、1回の辞書引きでコマンドを判定する）
+# キーは get_message_command() と同じ正規化（casefold）済みの値で持つ
+MESSAGE_COMMANDS = {
+    alias.casefold(): command
+    for alias, command in {
+        'ヘルプ': 'help',
+        '設定': 'settings',
+        **dict.fromkeys(['アップグレード', '有料プラン', '課金', 'プラン変更'], 'upgrade'),
+        **dict.fromkeys(['タスク', 'タスク一覧', 'タスクリスト', 'todo'], 'task_list'),
+        '全タスク': 'all_tasks',
+        **dict.fromkeys(['タスク追加', '追加'], 'add_task'),
+    }.items()
+}
+
+# 全角数字 → 半角数字の変換テーブル
+_ZEN_TO_HAN = str.maketrans('０１２３４５６７８９', '0123456789')
+
+# タスク完了コマンド（「完了1」形式を優先し、なければ「1完了」形式）
+_COMPLETE_TASK_PATTERNS = (
+    re.compile(r'完了[\s　]*(\d+)'),  # 完了1, 完了 1, 完了　1
+    re.compile(r'(\d+)[\s　]*完了'),  # 1完了, 1 完了, 1　完了
+)
+
+# レート制限の対象外とするコマンド（アップグレード関連と基本コマンド）
+RATE_LIMIT_EXEMPT_COMMANDS = frozenset(['help', 'settings', 'upgrade'])
+
+# メモ削除として扱う入力（小文字化して照合）
+MEMO_DELETE_KEYWORDS = frozenset(['削除', 'なし', 'クリア', '消す', 'delete', 'clear', 'none'])
+
 # 環境変数からGCP設定を取得
 PROJECT_ID = os.environ.get('GCP_PROJECT_ID')
 REGION = os.environ.get('GCP_REGION', 'asia-northeast1')
-SERVICE_ACCOUNT_EMAIL = os.environ.get(
-    'SERVICE_ACCOUNT_EMAIL',
-    f'webhook-handler@{PROJECT_ID}.iam.gserviceaccount.com'
+SERVICE_ACCOUNT_EMAIL = (
+    os.environ.get('SERVICE_ACCOUNT_EMAIL')
+    or f'webhook-handler@{PROJECT_ID}.iam.gserviceaccount.com'
 )
 
+# Cloud Tasksから呼び出すワーカーのURL（同じプロジェクトのCloud Functionとしてデプロイ）
+_FUNCTIONS_BASE_URL = f"https://{REGION}-{PROJECT_ID}.cloudfunctions.net"
+WORKER_URL_TASK_GENERATION = f"{_FUNCTIONS_BASE_URL}/task-generator-worker"
+WORKER_URL_PERSONALIZED_TASKS = f"{_FUNCTIONS_BASE_URL}/personalized-tasks-worker"
+WORKER_URL_TIPS_ENHANCEMENT = f"{_FUNCTIONS_BASE_URL}/tips-enhancement-worker"
+WORKER_URL_AI_RESPONSE = f"{_FUNCTIONS_BASE_URL}/ai-response-worker"
+
+# Secret Managerから取得した値のキャッシュ有効期間（秒）
+SECRET_CACHE_TTL_SECONDS = 3600
+
+# last_login_at を更新する間隔（秒）（メッセージごとの users への書き込みを省略する）
+LAST_LOGIN_UPDATE_INTERVAL_SECONDS = 60
+
+# line_user_id → users.id キャッシュの有効期間（秒）（対応関係は登録後に変わらない）
+USER_ID_CACHE_TTL_SECONDS = 3600
+
+# 基本タスク生成を「生成中」とみなす最大時間（秒）
+# ワーカーが異常終了して状態が in_progress のまま残っても、この時間を過ぎれば再投入できるようにする
+TASK_GENERATION_STALE_SECONDS = 900
+
+# AI応答のストリーミング時に先行送信する冒頭部分の最大文字数
+FIRST_CHUNK_MAX_CHARS = 250
+
+# AI応答に使うモデル（短い雑談・相槌は軽量モデル、手続きの質問は高精度モデル）
+AI_MODEL_LIGHT = 'gemini-2.5-flash'
+AI_MODEL_HEAVY = 'gemini-2.5-pro'
+
+# この文字数を超えるメッセージは高精度モデルで応答する
+AI_LIGHT_MESSAGE_MAX_CHARS = 30
+
 # グローバル変数（遅延初期化）
 _handler = None
 _configuration = None
+_messaging_api = None
 _engine = None
 _connector = None
 _gemini_client = None
 _subscription_manager = None
 _plan_controller = None
+_tasks_client = None
+# 遅延初期化の排他用（同時リクエストで複数のインスタンスを生成しないようにする）
+# 初期化処理が他の get_*() を呼ぶため再入可能なロックを使う
+_init_lock = threading.RLock()
+_secret_cache = {}  # secret_id -> (値, 取得時刻)
+_last_login_updated = {}  # line_user_id -> last_login_at を更新した時刻
+_user_id_cache = {}  # line_user_id -> (user_id, 取得時刻)
+
+# LINE返信後に実行するバックグラウンド処理用
+_executor = ThreadPoolExecutor(max_workers=4)
+_background = threading.local()
+
+# SQL文（リクエストごとにTextClauseを生成しないようモジュール読み込み時に構築）
+SQL_SAVE_USER_MESSAGE = sqlalchemy.text(
+    """
+    INSERT INTO conversation_history (user_id, role, message)
+    VALUES (:user_id, 'user', :message)
+    """
+)
+SQL_SAVE_ASSISTANT_MESSAGE = sqlalchemy.text(
+    """
+    INSERT INTO conversation_history (user_id, role, message)
+    VALUES (:user_id, 'assistant', :message)
+    """
+)
+SQL_TOUCH_USER_WITH_PROFILE = sqlalchemy.text(
+    """
+    WITH u AS (
+        UPDATE users
+        SET last_login_at = :last_login_at
+        WHERE line_user_id = :line_user_id
+        RETURNING id
+    )
+    SELECT u.id, up.relationship, up.prefecture, up.municipality, up.death_date
+    FROM u
+    LEFT JOIN user_profiles up ON u.id = up.user_id
+    """
+)
+SQL_UPSERT_FOLLOWER = sqlalchemy.text(
+    """
+    INSERT INTO users (line_user_id, display_name, status, last_login_at)
+    VALUES (:line_user_id, :display_name, 'active', :last_login_at)
+    ON CONFLICT (line_user_id)
+    DO UPDATE SET last_login_at = EXCLUDED.last_login_at
+    RETURNING id, (xmax = 0) AS inserted
+    """
+)
+SQL_GET_PROFILE = sqlalchemy.text(
+    """
+    SELECT relationship, prefecture, municipality, death_date
+    FROM user_profiles
+    WHERE user_id = :user_id
+    """
+)
+SQL_GET_AI_CONTEXT = sqlalchemy.text(
+    """
+    SELECT up.relationship, up.prefecture, up.municipality, up.death_date,
+        (
+            SELECT COALESCE(json_agg(json_build_array(h.role, h.message) ORDER BY h.created_at DESC), '[]'::json)
+            FROM (
+                SELECT role, message, created_at
+                FROM conversation_history
+                WHERE user_id = :user_id
+                ORDER BY created_at DESC
+                LIMIT 20
+            ) h
+        ) AS history
+    FROM users u
+    LEFT JOIN user_profiles up ON u.id = up.user_id
+    WHERE u.id = :user_id
+    """
+)
+SQL_GET_LAST_FLOW_STATE = sqlalchemy.text(
+    """
+    SELECT message
+    FROM conversation_history
+    WHERE user_id = :user_id AND role = 'system'
+    ORDER BY created_at DESC
+    LIMIT 1
+    """
+)
+# 入力フローの状態（systemメッセージ）の設定・クリア（:patternは 'editing:%' などの前方一致）
+SQL_SET_FLOW_STATE = sqlalchemy.text(
+    """
+    INSERT INTO conversation_history (user_id, role, message)
+    VALUES (:user_id, 'system', :data)
+    """
+)
+SQL_CLEAR_FLOW_STATE = sqlalchemy.text(
+    """
+    DELETE FROM conversation_history
+    WHERE user_id = :user_id AND role = 'system' AND message LIKE :pattern
+    """
+)
+# タスクの状態変更とtask_progressへの記録を1文で行う（対象タスクがなければ記録もしない）
+# ボタンの連打などで既に同じステータスの場合は更新・進捗記録を行わない
+# （タスクが存在すれば更新の有無に関わらず1行返す）
+SQL_SET_TASK_STATUS = sqlalchemy.text(
+    """
+    WITH target AS (
+        SELECT id
+        FROM tasks
+        WHERE id = :task_id AND user_id = :user_id
+    ), updated AS (
+        UPDATE tasks
+        SET status = :status
+        WHERE id = :task_id AND user_id = :user_id AND status <> :status
+        RETURNING id
+    ), logged AS (
+        INSERT INTO task_progress (task_id, status, completed_at)
+        SELECT id, :status, CAST(:completed_at AS TIMESTAMP)
+        FROM updated
+    )
+    SELECT id FROM target
+    """
+)
+SQL_GET_FLOW_STATE_LIKE = sqlalchemy.text(
+    """
+    SELECT message
+    FROM conversation_history
+    WHERE user_id = :user_id AND role = 'system' AND message LIKE :pattern
+    ORDER BY created_at DESC
+    LIMIT 1
+    """
+)
+SQL_GET_TASK_DETAIL = sqlalchemy.text(
+    """
+    SELECT t.id, t.title, t.description, t.due_date, t.priority, t.category, t.metadata,
+           COALESCE(p.task_index, -1) AS task_index
+    FROM tasks t
+    LEFT JOIN (
+        SELECT id, ROW_NUMBER() OVER (ORDER BY due_date ASC) - 1 AS task_index
+        FROM tasks
+        WHERE user_id = :user_id AND is_deleted = false AND status = 'pending'
+    ) p ON p.id = t.id
+    WHERE t.id = :task_id AND t.user_id = :user_id
+    """
+)
+# order_indexは末尾（ユーザーのタスクの最大値 + 1）で採番する
+# READ COMMITTEDでは同時に実行された文が同じMAXを読むため、insert_manual_task() でロックしてから実行する
+SQL_INSERT_MANUAL_TASK = sqlalchemy.text(
+    """
+    INSERT INTO tasks (user_id, title, description, category, priority, due_date, status, order_index)
+    SELECT :user_id, :title, :description, :category, :priority, CAST(:due_date AS date), 'pending',
+           COALESCE(MAX(order_index), 0) + 1
+    FROM tasks
+    WHERE user_id = :user_id
+    """
+)
+SQL_DELETE_USER_TASKS = sqlalchemy.text("DELETE FROM tasks WHERE user_id = :user_id")
+SQL_UPDATE_DEATH_DATE = sqlalchemy.text(
+    """
+    UPDATE user_profiles
+    SET death_date = :death_date
+    WHERE user_id = :user_id
+    RETURNING user_id, prefecture, municipality
+    """
+)
+SQL_GET_SUBSCRIPTION = sqlalchemy.text(
+    """
+    SELECT id, subscription_status, subscription_plan, subscription_start_date, subscription_end_date
+    FROM users
+    WHERE line_user_id = :line_user_id
+    """
+)
+# 有効なサブスクリプションのみ解約し、解約した場合は利用期限を返す
+SQL_CANCEL_SUBSCRIPTION = sqlalchemy.text(
+    """
+    UPDATE users
+    SET subscription_status = 'cancelled'
+    WHERE line_user_id = :line_user_id AND subscription_status = 'active'
+    RETURNING id, subscription_end_date
+    """
+)
+# ユーザー単位の処理を直列化するロック（トランザクション終了時に解放）
+SQL_ADVISORY_XACT_LOCK = sqlalchemy.text("SELECT pg_advisory_xact_lock(hashtext(:lock_key))")
+SQL_IS_TASK_GENERATION_IN_PROGRESS = sqlalchemy.text(
+    """
+    SELECT EXISTS (
+        SELECT 1 FROM task_generation_steps
+        WHERE user_id = :user_id AND step_name = 'basic' AND status = 'in_progress'
+          AND started_at > LOCALTIMESTAMP - make_interval(secs => :stale_seconds)
+    )
+    """
+)
+SQL_GET_FIRST_UNANSWERED_QUESTION = sqlalchemy.text(
+    """
+    SELECT question_text, question_type, options
+    FROM follow_up_questions
+    WHERE user_id = :user_id AND is_answered = false
+    ORDER BY display_order
+    LIMIT 1
+    """
+)
+
+
+# Quick Reply（内容が固定のものはpydanticの検証を毎回行わないようモジュール読み込み時に構築）
+YES_NO_QUICK_REPLY = QuickReply(
+    items=[
+        QuickReplyItem(action=MessageAction(label="はい", text="はい")),
+        QuickReplyItem(action=MessageAction(label="いいえ", text="いいえ"))
+    ]
+)
+# 初回登録時の故人との関係
+RELATIONSHIP_QUICK_REPLY = QuickReply(
+    items=[
+        QuickReplyItem(action=MessageAction(label=label, text=label))
+        for label in ("父", "母", "配偶者", "兄弟姉妹", "祖父母", "子", "その他")
+    ]
+)
+# 設定画面からの故人との関係の変更
+EDIT_RELATIONSHIP_QUICK_REPLY = QuickReply(
+    items=[
+        QuickReplyItem(action=MessageAction(label=label, text=label))
+        for label in ("配偶者", "子", "親", "兄弟姉妹", "孫", "その他")
+    ]
+)
+PREFECTURE_QUICK_REPLY = QuickReply(
+    items=[
+        QuickReplyItem(action=MessageAction(label=label, text=label))
+        for label in (
+            "東京都", "大阪府", "神奈川県", "愛知県", "埼玉県", "千葉県",
+            "兵庫県", "福岡県", "北海道", "京都府", "その他"
+        )
+    ]
+)
+TASK_DUE_DATE_QUICK_REPLY = QuickReply(
+    items=[
+        QuickReplyItem(
+            action=DatetimePickerAction(
+                label="📅 期限を選択",
+                data="action=add_task_due_date",
+                mode="date"
+            )
+        ),
+        QuickReplyItem(
+            action=MessageAction(label="期限なし", text="期限なし")
+        )
+    ]
+)
+UPDATE_DEATH_DATE_QUICK_REPLY = QuickReply(
+    items=[
+        QuickReplyItem(
+            action=DatetimePickerAction(
+                label="📅 日付を選択",
+                data="action=update_death_date",
+                mode="date"
+            )
+        )
+    ]
+)
+
+
+@lru_cache(maxsize=1)
+def get_death_date_quick_reply(today_iso: str) -> QuickReply:
+    """
+    死亡日選択用のDatetimepicker Quick Replyを取得（当日分をキャッシュ）
+
+    Args:
+        today_iso: 今日の日付（YYYY-MM-DD形式）。初期値と上限に使う
+
+    Returns:
+        QuickReply
+    """
+    return QuickReply(
+        items=[
+            QuickReplyItem(action=DatetimePickerAction(
+                label="日付を選択",
+                data="action=set_death_date",
+                mode="date",
+                initial=today_iso,
+                max=today_iso
+            ))
+        ]
+    )
+
+
+def format_date_ja(d) -> str:
+    """
+    日付を「YYYY年MM月DD日」形式の文字列にする（strftimeより軽量）
+
+    Args:
+        d: date または datetime
+
+    Returns:
+        フォーマット済みの日付文字列
+    """
+    return f"{d.year}年{d.month:02d}月{d.day:02d}日"
 
 
 def get_secret(secret_id: str) -> str:
@@ -84,53 +442,53 @@ def get_secret(secret_id: str) -> str:
     Raises:
         Exception: シークレット取得に失敗した場合
     """
+    # インスタンス内キャッシュが有効期間内ならSecret Managerへ問い合わせない
+    cached = _secret_cache.get(secret_id)
+    if cached and time.monotonic() - cached[1] < SECRET_CACHE_TTL_SECONDS:
+        return cached[0]
+
     try:
         client = secretmanager.SecretManagerServiceClient()
         name = f"projects/{PROJECT_ID}/secrets/{secret_id}/versions/latest"
         response = client.access_secret_version(request={"name": name})
         secret_value = response.payload.data.decode("UTF-8")
+        _secret_cache[secret_id] = (secret_value, time.monotonic())
 
         # ログにシークレット値を出力しない（セキュリティ対策）
-        print(f"✅ シークレット取得成功: {secret_id}")
+        logger.info("✅ シークレット取得成功: %s", secret_id)
         return secret_value
 
     except Exception as e:
         # エラー詳細をログに記録（シークレット値は含めない）
-        print(f"❌ シークレット取得エラー: secret_id={secret_id}, error={type(e).__name__}")
+        logger.error("❌ シークレット取得エラー: secret_id=%s, error=%s", secret_id, type(e).__name__)
         # 本番環境では適切なエラーハンドリングを実装
         raise Exception(f"Failed to retrieve secret: {secret_id}") from e
 
 
-def validate_signature(body: str, signature: str, channel_secret: str) -> bool:
-    """署名を検証"""
-    hash_value = hmac.new(
-        channel_secret.encode('utf-8'),
-        body.encode('utf-8'),
-        hashlib.sha256
-    ).digest()
-    calculated_signature = base64.b64encode(hash_value).decode('utf-8')
-    return calculated_signature == signature
-
-
 def get_handler():
     """LINE WebhookHandlerを取得（遅延初期化）"""
     global _handler
     if _handler is None:
-        channel_secret = get_secret('LINE_CHANNEL_SECRET')
-        _handler = WebhookHandler(channel_secret)
+        with _init_lock:
+            if _handler is None:
+                channel_secret = get_secret('LINE_CHANNEL_SECRET')
+                handler = WebhookHandler(channel_secret)
+
+                # イベントハンドラを登録
+                @handler.add(FollowEvent)
+                def handle_follow_event(event: FollowEvent):
+                    handle_follow(event)
 
-        # イベントハンドラを登録
-        @_handler.add(FollowEvent)
-        def handle_follow_event(event: FollowEvent):
-            handle_follow(event)
+                @handler.add(MessageEvent, message=TextMessageContent)
+                def handle_message_event(event: MessageEvent):
+                    handle_message(event)
 
-        @_handler.add(MessageEvent, message=TextMessageContent)
-        def handle_message_event(event: MessageEvent):
-            handle_message(event)
+                @handler.add(PostbackEvent)
+                def handle_postback_event(event: PostbackEvent):
+                    handle_postback(event)
 
-        @_handler.add(PostbackEvent)
-        def handle_postback_event(event: PostbackEvent):
-            handle_postback(event)
+                # 登録が終わってから公開する（他スレッドに登録途中のハンドラを見せない）
+                _handler = handler
 
     return _handler
 
@@ -139,57 +497,88 @@ def get_configuration():
     """LINE API Configurationを取得（遅延初期化）"""
     global _configuration
     if _configuration is None:
-        channel_access_token = get_secret('LINE_CHANNEL_ACCESS_TOKEN')
-        _configuration = Configuration(access_token=channel_access_token)
+        with _init_lock:
+            if _configuration is None:
+                channel_access_token = get_secret('LINE_CHANNEL_ACCESS_TOKEN')
+                _configuration = Configuration(access_token=channel_access_token)
     return _configuration
 
 
+def get_messaging_api():
+    """LINE MessagingApiを取得（遅延初期化）
+
+    ApiClient内のHTTPコネクションプールを使い回し、LINE APIへの
+    TLS接続をリクエスト間で維持する
+    """
+    global _messaging_api
+    if _messaging_api is None:
+        with _init_lock:
+            if _messaging_api is None:
+                _messaging_api = MessagingApi(ApiClient(get_configuration()))
+    return _messaging_api
+
+
 def get_db_engine():
     """Database Engineを取得（遅延初期化）"""
-    global _engine, _connector
+    global _engine
 
     if _engine is None:
-        # Database接続設定
-        db_connection_name = get_secret('DB_CONNECTION_NAME')
-        db_user = get_secret('DB_USER')
-        db_password = get_secret('DB_PASSWORD')
-        db_name = get_secret('DB_NAME')
-
-        # Cloud SQL Connector
-        _connector = Connector()
-
-        def get_db_connection():
-            """Cloud SQL接続を取得"""
-            conn = _connector.connect(
-                db_connection_name,
-                "pg8000",
-                user=db_user,
-                password=db_password,
-                db=db_name
-            )
-            return conn
-
-        # SQLAlchemy エンジン（接続プール設定を追加）
-        _engine = sqlalchemy.create_engine(
-            "postgresql+pg8000://",
-            creator=get_db_connection,
-            pool_size=5,           # 同時接続数の上限
-            max_overflow=10,       # pool_sizeを超えた場合の追加接続数
-            pool_timeout=30,       # 接続取得のタイムアウト（秒）
-            pool_recycle=1800,     # 接続の再利用期限（30分）
-            pool_pre_ping=True,    # 接続の有効性を事前確認
-        )
+        with _init_lock:
+            if _engine is None:
+                _engine = _create_db_engine()
 
     return _engine
 
 
+def _create_db_engine():
+    """Database Engineを生成（get_db_engine() からロック内で一度だけ呼ばれる）"""
+    global _connector
+
+    # Database接続設定
+    db_connection_name = get_secret('DB_CONNECTION_NAME')
+    db_user = get_secret('DB_USER')
+    db_password = get_secret('DB_PASSWORD')
+    db_name = get_secret('DB_NAME')
+
+    # Cloud SQL Connector
+    _connector = Connector()
+
+    def get_db_connection():
+        """Cloud SQL接続を取得"""
+        conn = _connector.connect(
+            db_connection_name,
+            "pg8000",
+            user=db_user,
+            password=db_password,
+            db=db_name
+        )
+        return conn
+
+    # SQLAlchemy エンジン（接続プール設定を追加）
+    return sqlalchemy.create_engine(
+        "postgresql+pg8000://",
+        creator=get_db_connection,
+        # インスタンスあたりの同時リクエスト数（deploy.sh の CONCURRENCY=15）に合わせる
+        pool_size=15,          # 同時接続数の上限（deploy.sh の CONCURRENCY と同じ値にする）
+        max_overflow=5,        # バックグラウンド処理などでpool_sizeを超えた場合の追加接続数
+        pool_timeout=10,       # 接続取得のタイムアウト（秒）
+        pool_use_lifo=True,    # 直近に使った接続を優先して再利用する
+        pool_recycle=1800,     # 接続の再利用期限（30分）
+        # チェックアウト毎の SELECT 1 を避け、接続の鮮度は pool_recycle で担保する
+        # （pg8000 は TCP keepalive がデフォルトで有効）
+        pool_pre_ping=False,
+    )
+
+
 def get_gemini_client():
     """Gemini Clientを取得（遅延初期化）"""
     global _gemini_client
 
     if _gemini_client is None:
-        gemini_api_key = get_secret('GEMINI_API_KEY')
-        _gemini_client = genai.Client(api_key=gemini_api_key)
+        with _init_lock:
+            if _gemini_client is None:
+                gemini_api_key = get_secret('GEMINI_API_KEY')
+                _gemini_client = genai.Client(api_key=gemini_api_key)
 
     return _gemini_client
 
@@ -199,9 +588,11 @@ def get_subscription_manager():
     global _subscription_manager
 
     if _subscription_manager is None:
-        engine = get_db_engine()
-        stripe_api_key = get_secret('STRIPE_API_KEY').strip()
-        _subscription_manager = SubscriptionManager(engine, stripe_api_key)
+        with _init_lock:
+            if _subscription_manager is None:
+                engine = get_db_engine()
+                stripe_api_key = get_secret('STRIPE_API_KEY').strip()
+                _subscription_manager = SubscriptionManager(engine, stripe_api_key)
 
     return _subscription_manager
 
@@ -211,34 +602,166 @@ def get_plan_controller():
     global _plan_controller
 
     if _plan_controller is None:
-        subscription_manager = get_subscription_manager()
-        _plan_controller = PlanController(subscription_manager)
+        with _init_lock:
+            if _plan_controller is None:
+                subscription_manager = get_subscription_manager()
+                _plan_controller = PlanController(subscription_manager)
 
     return _plan_controller
 
 
-def enqueue_task_generation(user_id: str, line_user_id: str):
+def get_tasks_client():
+    """Cloud Tasks Clientを取得（遅延初期化）"""
+    global _tasks_client
+
+    if _tasks_client is None:
+        with _init_lock:
+            if _tasks_client is None:
+                _tasks_client = tasks_v2.CloudTasksClient()
+
+    return _tasks_client
+
+
+@lru_cache(maxsize=8)
+def get_queue_path(queue_name: str) -> str:
+    """Cloud Tasksのキューパスを取得（キュー名ごとにキャッシュ）"""
+    return get_tasks_client().queue_path(PROJECT_ID, REGION, queue_name)
+
+
+def submit_background(fn, *args, **kwargs):
+    """
+    処理をバックグラウンドスレッドに投入
+
+    LINE返信を先に送るために使用する。投入した処理は
+    wait_background_tasks() でリクエスト終了前に待ち合わせる。
+    """
+    future = _executor.submit(fn, *args, **kwargs)
+    if not hasattr(_background, 'futures'):
+        _background.futures = []
+    _background.futures.append(future)
+    return future
+
+
+def wait_background_tasks():
+    """現在のリクエストで投入したバックグラウンド処理の完了を待つ"""
+    futures = getattr(_background, 'futures', None)
+    if not futures:
+        return
+
+    _background.futures = []
+    wait(futures)
+    for future in futures:
+        error = future.exception()
+        if error:
+            logger.error("❌ バックグラウンド処理エラー: %s: %s", type(error).__name__, error)
+
+
+def get_user_with_profile(line_user_id: str, conn):
+    """
+    ユーザーIDとプロフィールを取得
+
+    プロフィールは他のインスタンスで変更されることがあるため毎回DBから読み、
+    last_login_at の更新のみ LAST_LOGIN_UPDATE_INTERVAL_SECONDS ごとに1回に間引く
+
+    Returns:
+        (user_id, relationship, prefecture, municipality, death_date)（未登録の場合はNone）
+    """
+    updated = _last_login_updated.get(line_user_id)
+    cached = _user_id_cache.get(line_user_id)
+    if updated and cached and time.monotonic() - updated < LAST_LOGIN_UPDATE_INTERVAL_SECONDS:
+        user_id = cached[0]
+        profile = conn.execute(SQL_GET_PROFILE, {"user_id": user_id}).fetchone()
+        return (user_id,) + (tuple(profile) if profile else (None, None, None, None))
+
+    # ユーザーのlast_login_atを更新し、同じ往復でユーザー情報とプロフィールを取得
+    user_data = conn.execute(
+        SQL_TOUCH_USER_WITH_PROFILE,
+        {
+            "last_login_at": datetime.now(timezone.utc),
+            "line_user_id": line_user_id
+        }
+    ).fetchone()
+    conn.commit()
+    if user_data:
+        cache_user_id(line_user_id, user_data[0])
+        _last_login_updated[line_user_id] = time.monotonic()
+    return user_data
+
+
+def cache_user_id(line_user_id: str, user_id):
+    """line_user_idとusers.idの対応をキャッシュ"""
+    _user_id_cache[line_user_id] = (user_id, time.monotonic())
+
+
+def get_subscription(line_user_id: str, conn=None):
     """
-    Cloud Tasksにタスク生成ジョブを投入
+    サブスクリプション情報を取得（他のインスタンスでの解約を即時に反映するため毎回DBから取得する）
 
     Args:
-        user_id: データベースのユーザーID（UUID）
-        line_user_id: LINEユーザーID（Push通知用）
+        line_user_id: LINEユーザーID
+        conn: 使用する接続（未指定時は新たに取得）
+
+    Returns:
+        (user_id, subscription_status, subscription_plan, subscription_start_date, subscription_end_date)
+        （未登録の場合はNone）
+    """
+    if conn is None:
+        with get_db_engine().connect() as conn:
+            return get_subscription(line_user_id, conn)
+
+    subscription = conn.execute(
+        SQL_GET_SUBSCRIPTION,
+        {"line_user_id": line_user_id}
+    ).fetchone()
+    return tuple(subscription) if subscription else None
+
+
+def resolve_user_id(line_user_id: str, conn=None):
+    """
+    line_user_idからusers.idを取得（キャッシュが有効な間はDBを参照しない）
+
+    Args:
+        line_user_id: LINEユーザーID
+        conn: キャッシュにない場合に使う接続（未指定時は新たに取得）
+
+    Returns:
+        users.id（未登録の場合はNone）
     """
-    client = tasks_v2.CloudTasksClient()
+    cached = _user_id_cache.get(line_user_id)
+    if cached and time.monotonic() - cached[1] < USER_ID_CACHE_TTL_SECONDS:
+        return cached[0]
+
+    if conn is None:
+        with get_db_engine().connect() as conn:
+            return resolve_user_id(line_user_id, conn)
+
+    user_result = conn.execute(
+        sqlalchemy.text("SELECT id FROM users WHERE line_user_id = :line_user_id"),
+        {"line_user_id": line_user_id}
+    ).fetchone()
+    if not user_result:
+        return None
 
-    # Cloud Tasksのキュー名
-    queue_name = 'task-generation-queue'
-    parent = client.queue_path(PROJECT_ID, REGION, queue_name)
+    cache_user_id(line_user_id, user_result[0])
+    return user_result[0]
 
-    # ワーカーのURL（同じCloud Functionとしてデプロイ）
-    worker_url = f"https://{REGION}-{PROJECT_ID}.cloudfunctions.net/task-generator-worker"
 
-    # タスクペイロード（両方のIDを渡す）
-    payload = json.dumps({
-        'user_id': str(user_id),
-        'line_user_id': line_user_id
-    }).encode()
+def _enqueue(worker_url: str, payload: dict, queue_name: str = 'task-generation-queue',
+             task_id: str = None):
+    """
+    ワーカー宛てのHTTPタスクをCloud Tasksに投入（各enqueue_*の共通処理）
+
+    Args:
+        worker_url: 呼び出すワーカーのURL（WORKER_URL_*）
+        payload: ワーカーに渡すJSONペイロード
+        queue_name: 投入先のキュー名
+        task_id: タスクID（指定時は同名タスクの重複投入を防ぐ）
+
+    Returns:
+        作成されたタスク（同名タスクが投入済みの場合はNone）
+    """
+    client = get_tasks_client()
+    parent = get_queue_path(queue_name)
 
     # Cloud Taskを作成（OIDC認証トークン付き）
     task = {
@@ -246,105 +769,141 @@ def enqueue_task_generation(user_id: str, line_user_id: str):
             'http_method': tasks_v2.HttpMethod.POST,
             'url': worker_url,
             'headers': {'Content-Type': 'application/json'},
-            'body': payload,
+            'body': json.dumps(payload).encode(),
             'oidc_token': {
                 'service_account_email': SERVICE_ACCOUNT_EMAIL
             }
         }
     }
 
-    # タスクをキューに追加
-    response = client.create_task(request={'parent': parent, 'task': task})
-    print(f"📤 Cloud Taskを投入しました: {response.name}")
+    # Cloud Tasksのタスク名重複排除を利用する
+    if task_id:
+        task['name'] = f"{parent}/tasks/{task_id}"
 
+    try:
+        return client.create_task(request={'parent': parent, 'task': task})
+    except AlreadyExists:
+        return None
 
-def enqueue_personalized_task_generation(user_id: str, line_user_id: str):
-    """Cloud Tasksに個別タスク生成ジョブを投入"""
-    client = tasks_v2.CloudTasksClient()
-    queue_name = 'task-generation-queue'
-    parent = client.queue_path(PROJECT_ID, REGION, queue_name)
 
-    worker_url = f"https://{REGION}-{PROJECT_ID}.cloudfunctions.net/personalized-tasks-worker"
+def enqueue_task_generation(user_id: str, line_user_id: str):
+    """
+    Cloud Tasksにタスク生成ジョブを投入（生成中の場合は投入しない）
 
-    payload = json.dumps({
-        'user_id': str(user_id),
-        'line_user_id': line_user_id
-    }).encode()
+    Args:
+        user_id: データベースのユーザーID（UUID）
+        line_user_id: LINEユーザーID（Push通知用）
+    """
+    engine = get_db_engine()
+
+    # 連打や生成中のメッセージ送信でジョブが重複し、タスクが二重に作成されるのを防ぐ
+    with engine.connect() as conn:
+        conn.execute(SQL_ADVISORY_XACT_LOCK, {"lock_key": f"task-generation:{user_id}"})
+        in_progress = conn.execute(
+            SQL_IS_TASK_GENERATION_IN_PROGRESS,
+            {"user_id": user_id, "stale_seconds": TASK_GENERATION_STALE_SECONDS}
+        ).scalar()
+        if in_progress:
+            logger.info("ℹ️ タスク生成中のため投入をスキップ: user_id=%s", user_id)
+            return
+
+        # 生成中として記録してから投入する（記録のコミットでロックも解放される）
+        ConversationFlowManager(conn).set_task_generation_step_status(user_id, 'basic', 'in_progress')
+
+    try:
+        response = _enqueue(
+            WORKER_URL_TASK_GENERATION,
+            {'user_id': str(user_id), 'line_user_id': line_user_id}
+        )
+    except Exception as e:
+        # 投入できなかった場合は生成中の記録を残さない（次の操作で再投入できるようにする）
+        with engine.connect() as conn:
+            ConversationFlowManager(conn).set_task_generation_step_status(
+                user_id, 'basic', 'failed', error_message=f"enqueue failed: {e}"
+            )
+        raise
+    logger.info("📤 Cloud Taskを投入しました: %s", response.name)
 
-    task = {
-        'http_request': {
-            'http_method': tasks_v2.HttpMethod.POST,
-            'url': worker_url,
-            'headers': {'Content-Type': 'application/json'},
-            'body': payload,
-            'oidc_token': {
-                'service_account_email': SERVICE_ACCOUNT_EMAIL
-            }
-        }
-    }
 
-    response = client.create_task(request={'parent': parent, 'task': task})
-    print(f"📤 個別タスク生成ジョブを投入: {response.name}")
+def enqueue_personalized_task_generation(user_id: str, line_user_id: str):
+    """Cloud Tasksに個別タスク生成ジョブを投入"""
+    response = _enqueue(
+        WORKER_URL_PERSONALIZED_TASKS,
+        {'user_id': str(user_id), 'line_user_id': line_user_id}
+    )
+    logger.info("📤 個別タスク生成ジョブを投入: %s", response.name)
 
 
-def enqueue_tips_enhancement(user_id: str, line_user_id: str):
-    """Cloud TasksにTips収集ジョブを投入"""
-    client = tasks_v2.CloudTasksClient()
-    queue_name = 'task-generation-queue'
-    parent = client.queue_path(PROJECT_ID, REGION, queue_name)
+def enqueue_tips_enhancement(user_id: str, line_user_id: str, task_id: str = None):
+    """Cloud TasksにTips収集ジョブを投入（task_id指定時は同名ジョブを重複投入しない）"""
+    response = _enqueue(
+        WORKER_URL_TIPS_ENHANCEMENT,
+        {'user_id': str(user_id), 'line_user_id': line_user_id},
+        task_id=task_id
+    )
+    if response is None:
+        logger.info("ℹ️ Tips収集ジョブは投入済みのためスキップ: %s", task_id)
+        return
+    logger.info("📤 Tips収集ジョブを投入: %s", response.name)
 
-    worker_url = f"https://{REGION}-{PROJECT_ID}.cloudfunctions.net/tips-enhancement-worker"
 
-    payload = json.dumps({
-        'user_id': str(user_id),
-        'line_user_id': line_user_id
-    }).encode()
+def enqueue_ai_response_generation(user_id: str, line_user_id: str, user_message: str, user_message_saved: bool = False):
+    """Cloud TasksにAI応答生成ジョブを投入（user_message_saved=Trueならワーカーでは会話履歴に保存しない）"""
+    response = _enqueue(
+        WORKER_URL_AI_RESPONSE,
+        {
+            'user_id': str(user_id),
+            'line_user_id': line_user_id,
+            'user_message': user_message,
+            'user_message_saved': user_message_saved
+        },
+        # 削除したキュー名は30日間再利用不可のため、v2を使用
+        queue_name='task-generation-queue-v2'
+    )
+    logger.info("📤 AI応答生成ジョブを投入: %s", response.name)
 
-    task = {
-        'http_request': {
-            'http_method': tasks_v2.HttpMethod.POST,
-            'url': worker_url,
-            'headers': {'Content-Type': 'application/json'},
-            'body': payload,
-            'oidc_token': {
-                'service_account_email': SERVICE_ACCOUNT_EMAIL
+
+def save_user_message(user_id: str, message: str):
+    """ユーザーメッセージを会話履歴に保存"""
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        conn.execute(
+            SQL_SAVE_USER_MESSAGE,
+            {
+                "user_id": user_id,
+                "message": message
             }
-        }
-    }
+        )
 
-    response = client.create_task(request={'parent': parent, 'task': task})
-    print(f"📤 Tips収集ジョブを投入: {response.name}")
 
+def save_user_message_and_enqueue_ai_response(user_id: str, line_user_id: str, message: str):
+    """
+    ユーザーメッセージを会話履歴に保存してからAI応答生成ジョブを投入
 
-def enqueue_ai_response_generation(user_id: str, line_user_id: str, user_message: str):
-    """Cloud TasksにAI応答生成ジョブを投入"""
-    client = tasks_v2.CloudTasksClient()
-    # 削除したキュー名は30日間再利用不可のため、v2を使用
-    queue_name = 'task-generation-queue-v2'
-    parent = client.queue_path(PROJECT_ID, REGION, queue_name)
+    ワーカーが会話履歴を読む時点で保存が確定しているよう、同じスレッドで順に実行する。
+    保存に失敗した場合はワーカー側で保存させる。
+    """
+    try:
+        save_user_message(user_id, message)
+        saved = True
+    except Exception as e:
+        logger.error("❌ ユーザーメッセージ保存エラー（ワーカーで再保存）: %s: %s", type(e).__name__, e)
+        saved = False
 
-    worker_url = f"https://{REGION}-{PROJECT_ID}.cloudfunctions.net/ai-response-worker"
+    enqueue_ai_response_generation(user_id, line_user_id, message, user_message_saved=saved)
 
-    payload = json.dumps({
-        'user_id': str(user_id),
-        'line_user_id': line_user_id,
-        'user_message': user_message
-    }).encode()
 
-    task = {
-        'http_request': {
-            'http_method': tasks_v2.HttpMethod.POST,
-            'url': worker_url,
-            'headers': {'Content-Type': 'application/json'},
-            'body': payload,
-            'oidc_token': {
-                'service_account_email': 'webhook-handler@uketsuguai-dev.iam.gserviceaccount.com'
+def save_assistant_message(user_id: str, message: str):
+    """AI応答を会話履歴に保存（応答の送信と並行してバックグラウンドで実行）"""
+    engine = get_db_engine()
+    with engine.begin() as conn:
+        conn.execute(
+            SQL_SAVE_ASSISTANT_MESSAGE,
+            {
+                "user_id": user_id,
+                "message": message
             }
-        }
-    }
-
-    response = client.create_task(request={'parent': parent, 'task': task})
-    print(f"📤 AI応答生成ジョブを投入: {response.name}")
+        )
 
 
 @functions_framework.http
@@ -362,80 +921,68 @@ def ai_response_worker(request: Request):
         if not all([user_id, line_user_id, user_message]):
             return jsonify({"error": "user_id, line_user_id, and user_message are required"}), 400
 
-        print(f"🔄 AI応答生成開始: user_id={user_id}")
+        logger.info("🔄 AI応答生成開始: user_id=%s", user_id)
 
-        # ユーザーメッセージを会話履歴に保存（非同期処理のため明示的に保存）
-        engine = get_db_engine()
-        with engine.connect() as conn:
-            # 最新の会話履歴をチェック（重複回避）
-            latest_message = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT message, role
-                    FROM conversation_history
-                    WHERE user_id = :user_id
-                    ORDER BY created_at DESC
-                    LIMIT 1
-                    """
-                ),
-                {"user_id": user_id}
-            ).fetchone()
-
-            # 最新メッセージがユーザーメッセージと異なる場合のみ保存
-            if not latest_message or latest_message[0] != user_message or latest_message[1] != 'user':
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        INSERT INTO conversation_history (user_id, role, message)
-                        VALUES (:user_id, 'user', :message)
-                        """
-                    ),
-                    {
-                        "user_id": user_id,
-                        "message": user_message
-                    }
-                )
-                conn.commit()
-                print(f"💾 ユーザーメッセージを会話履歴に保存: {user_message[:50]}...")
+        # ユーザーメッセージを会話履歴に保存（webhookから投入されたジョブは保存済みのためスキップ）
+        if not request_json.get('user_message_saved'):
+            save_user_message(user_id, user_message)
+            logger.info("💾 ユーザーメッセージを会話履歴に保存: %s...", user_message[:50])
 
-        # AI応答を生成
-        ai_reply = generate_ai_response(user_id, user_message)
+        # LINE Push API で通知（冒頭部分は生成途中で先に送信）
+        line_bot_api = get_messaging_api()
+        sent_text = []
 
-        # LINE Push API で通知
-        configuration = get_configuration()
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
+        def push_first_chunk(text: str):
             line_bot_api.push_message(
                 PushMessageRequest(
                     to=line_user_id,
-                    messages=[TextMessage(text=ai_reply)]
+                    messages=[TextMessage(text=text)]
                 )
             )
+            sent_text.append(text)
+
+        # AI応答を生成
+        ai_reply = generate_ai_response(user_id, user_message, on_first_chunk=push_first_chunk)
+
+        # 送信済みの冒頭部分を除いた残りを送信
+        remaining = ai_reply[len(sent_text[0]):] if sent_text and ai_reply.startswith(sent_text[0]) else ai_reply
+        if remaining.strip():
+            try:
+                line_bot_api.push_message(
+                    PushMessageRequest(
+                        to=line_user_id,
+                        messages=[TextMessage(text=remaining.strip())]
+                    )
+                )
+            except Exception as e:
+                # 応答は生成・保存済みのため、リトライで再生成しないよう送信エラーとして終了する
+                logger.error("❌ AI応答Push送信エラー: line_user_id=%s, error=%s", line_user_id, e)
+                return jsonify({"status": "push_failed"}), 200
 
-        print(f"📤 AI応答Push通知送信完了: line_user_id={line_user_id}")
+        logger.info("📤 AI応答Push通知送信完了: line_user_id=%s", line_user_id)
         return jsonify({"status": "success"}), 200
 
     except Exception as e:
-        print(f"❌ AI応答生成エラー: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ AI応答生成エラー: %s", e)
         try:
             if 'line_user_id' in locals() and line_user_id:
-                configuration = get_configuration()
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=line_user_id,
-                            messages=[TextMessage(
-                                text="申し訳ございません。AIの応答生成中にエラーが発生しました。"
-                            )]
-                        )
+                line_bot_api = get_messaging_api()
+                line_bot_api.push_message(
+                    PushMessageRequest(
+                        to=line_user_id,
+                        messages=[TextMessage(
+                            text="申し訳ございません。AIの応答生成中にエラーが発生しました。"
+                        )]
                     )
+                )
         except:
             pass
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        # 会話履歴の保存が終わるまでインスタンスを解放しない
+        wait_background_tasks()
+
 
 @functions_framework.http
 def generate_tasks_worker(request: Request):
@@ -445,7 +992,8 @@ def generate_tasks_worker(request: Request):
     Cloud Tasksから呼び出され、基本タスクを生成してPush通知する
     完了後、追加質問を生成してユーザーに送信
     """
-    from task_generator import generate_basic_tasks, get_task_summary_message
+    # 追加質問の並行生成（エラー時もリクエスト終了前に完了を待つ）
+    questions_future = None
 
     # リクエストボディを取得
     try:
@@ -464,36 +1012,30 @@ def generate_tasks_worker(request: Request):
         # データベース接続
         engine = get_db_engine()
 
-        # ユーザー所有権検証
+        # 1本の接続で所有権検証から会話状態の更新までを行う
+        # （各ステップの状態は ConversationFlowManager 内でコミットされる）
         with engine.connect() as conn:
+            # ユーザー所有権検証
             try:
                 verify_user_ownership(conn, line_user_id, user_id)
             except AuthorizationError as e:
-                print(f"❌ 認可エラー: {e}")
+                logger.error("❌ 認可エラー: %s", e)
                 return jsonify({"error": "Unauthorized access"}), 403
 
-        print(f"🔄 Step 1: 基本タスク生成開始: user_id={user_id}")
+            logger.info("🔄 Step 1: 基本タスク生成開始: user_id=%s", user_id)
 
-        # 会話フロー管理初期化
-        with engine.connect() as conn:
+            # 会話フロー管理初期化
             flow_manager = ConversationFlowManager(conn)
             flow_manager.set_task_generation_step_status(user_id, 'basic', 'in_progress')
 
-        # ユーザープロフィールを取得
-        with engine.connect() as conn:
+            # ユーザープロフィールを取得
             profile_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT relationship, prefecture, municipality, death_date
-                    FROM user_profiles
-                    WHERE user_id = :user_id
-                    """
-                ),
+                SQL_GET_PROFILE,
                 {"user_id": user_id}
             ).fetchone()
 
             if not profile_data:
-                print(f"⚠️ ユーザープロフィールが見つかりません: {user_id}")
+                logger.warning("⚠️ ユーザープロフィールが見つかりません: %s", user_id)
                 return jsonify({"error": "User profile not found"}), 404
 
             profile = {
@@ -503,49 +1045,43 @@ def generate_tasks_worker(request: Request):
                 'death_date': profile_data[3]
             }
 
-        # Step 1: 基本タスク生成
-        with engine.connect() as conn:
+            # 追加質問は基本タスクの内容に依存しない（関係性から決まる）ため、
+            # 別接続で基本タスク生成（Gemini呼び出し）と並行して生成・保存し、
+            # 最初に送る未回答の質問も同じ接続で取得しておく
+            # （再生成時は回答済みの質問が残っているため questions[0] ではなくDBから取得する）
+            def generate_questions():
+                with engine.connect() as questions_conn:
+                    generated = generate_follow_up_questions(user_id, profile, [], questions_conn)
+                    first_question = questions_conn.execute(
+                        SQL_GET_FIRST_UNANSWERED_QUESTION,
+                        {'user_id': user_id}
+                    ).fetchone()
+                    return generated, first_question
+
+            questions_future = _executor.submit(generate_questions)
+
+            # Step 1: 基本タスク生成
             tasks = generate_basic_tasks(user_id, profile, conn)
 
-        print(f"✅ Step 1完了: {len(tasks)}件の基本タスクを生成")
+            logger.info("✅ Step 1完了: %s件の基本タスクを生成", len(tasks))
 
-        # Step 1完了をマーク
-        with engine.connect() as conn:
-            flow_manager = ConversationFlowManager(conn)
+            # Step 1完了をマーク
             flow_manager.set_task_generation_step_status(
                 user_id, 'basic', 'completed',
                 metadata={'task_count': len(tasks)}
             )
 
-        # 追加質問を生成
-        with engine.connect() as conn:
-            questions = generate_follow_up_questions(user_id, profile, tasks, conn)
-
-        print(f"✅ 追加質問生成完了: {len(questions)}件")
+            # 追加質問の生成完了を待つ
+            questions, first_question_data = questions_future.result()
 
-        # サマリーメッセージ + 追加質問
-        municipality = profile['municipality']
-        summary_message = get_task_summary_message(tasks, municipality)
+            logger.info("✅ 追加質問生成完了: %s件", len(questions))
 
-        # 追加質問の最初の質問を取得
-        with engine.connect() as conn:
-            first_question_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT question_text, question_type, options
-                    FROM follow_up_questions
-                    WHERE user_id = :user_id AND is_answered = false
-                    ORDER BY display_order
-                    LIMIT 1
-                    """
-                ),
-                {'user_id': user_id}
-            ).fetchone()
+            # サマリーメッセージ + 追加質問
+            municipality = profile['municipality']
+            summary_message = get_task_summary_message(tasks, municipality)
 
-        # LINE Push API で通知
-        configuration = get_configuration()
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
+            # LINE Push API で通知
+            line_bot_api = get_messaging_api()
 
             messages = [TextMessage(text=summary_message)]
 
@@ -558,17 +1094,10 @@ def generate_tasks_worker(request: Request):
                 question_message = format_question_for_line(question_obj)
 
                 # Quick Replyで質問
-                quick_reply = QuickReply(
-                    items=[
-                        QuickReplyItem(action=MessageAction(label="はい", text="はい")),
-                        QuickReplyItem(action=MessageAction(label="いいえ", text="いいえ"))
-                    ]
-                )
-
                 messages.append(
                     TextMessage(
                         text=f"\n\n📝 より詳細なタスクを生成するため、いくつか質問させてください。\n\n{question_message}",
-                        quick_reply=quick_reply
+                        quick_reply=YES_NO_QUICK_REPLY
                     )
                 )
 
@@ -579,11 +1108,9 @@ def generate_tasks_worker(request: Request):
                 )
             )
 
-        print(f"📤 Push通知送信完了: line_user_id={line_user_id}")
+            logger.info("📤 Push通知送信完了: line_user_id=%s", line_user_id)
 
-        # 会話状態を「追加質問待ち」に設定
-        with engine.connect() as conn:
-            flow_manager = ConversationFlowManager(conn)
+            # 会話状態を「追加質問待ち」に設定
             flow_manager.set_state(
                 user_id,
                 'awaiting_follow_up_answers',
@@ -598,9 +1125,7 @@ def generate_tasks_worker(request: Request):
         }), 200
 
     except Exception as e:
-        print(f"❌ タスク生成エラー: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ タスク生成エラー: %s", e)
 
         # エラー時はStep 1をfailedにマーク
         if 'user_id' in locals():
@@ -614,22 +1139,51 @@ def generate_tasks_worker(request: Request):
         # エラー時もユーザーに通知
         try:
             if 'line_user_id' in locals() and line_user_id:
-                configuration = get_configuration()
-                with ApiClient(configuration) as api_client:
-                    line_bot_api = MessagingApi(api_client)
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=line_user_id,
-                            messages=[TextMessage(
-                                text="⚠️ タスク生成中にエラーが発生しました。\n\nお手数ですが、しばらく時間をおいて再度プロフィール登録をお試しください。"
-                            )]
-                        )
+                line_bot_api = get_messaging_api()
+                line_bot_api.push_message(
+                    PushMessageRequest(
+                        to=line_user_id,
+                        messages=[TextMessage(
+                            text="⚠️ タスク生成中にエラーが発生しました。\n\nお手数ですが、しばらく時間をおいて再度プロフィール登録をお試しください。"
+                        )]
                     )
+                )
         except:
             pass
 
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        # 応答後はCPUが割り当てられないため、追加質問の保存がトランザクション途中で止まらないよう待ち合わせる
+        if questions_future is not None:
+            wait([questions_future])
+
+
+def send_reply(reply_token: str, reply_message, alt_text: str = "メッセージ", quick_reply=None):
+    """
+    返信を送信（辞書・FlexContainerはFlex Message、それ以外はテキストメッセージとして送る）
+
+    Args:
+        reply_token: リプライトークン
+        reply_message: Flex Messageのコンテナ（辞書または構築済みのFlexContainer）またはテキスト
+        alt_text: Flex Messageの代替テキスト
+        quick_reply: テキストメッセージに付けるQuick Reply（任意）
+    """
+    if isinstance(reply_message, FlexContainer):
+        # 内容が固定のメッセージはモジュールロード時に構築済みのものをそのまま使う
+        message = FlexMessage(alt_text=alt_text, contents=reply_message)
+    elif isinstance(reply_message, dict):
+        message = FlexMessage(alt_text=alt_text, contents=FlexContainer.from_dict(reply_message))
+    else:
+        message = TextMessage(text=reply_message, quick_reply=quick_reply)
+
+    get_messaging_api().reply_message(
+        ReplyMessageRequest(
+            reply_token=reply_token,
+            messages=[message]
+        )
+    )
+
 
 @functions_framework.http
 def webhook(request: Request):
@@ -639,32 +1193,23 @@ def webhook(request: Request):
     signature = request.headers.get('X-Line-Signature', '')
     body = request.get_data(as_text=True)
 
-    print(f"Received webhook. Signature: {signature}, Body length: {len(body)}")
-
-    # 手動で署名検証
-    channel_secret = get_secret('LINE_CHANNEL_SECRET')
-    print(f"Channel Secret length: {len(channel_secret)}")
-
-    is_valid = validate_signature(body, signature, channel_secret)
-    print(f"Manual signature validation: {is_valid}")
+    logger.debug("Received webhook. Body length: %d", len(body))
 
+    # 署名検証は get_handler() の WebhookHandler が handle() 内で行う
     try:
         handler = get_handler()
-        print(f"Handler initialized successfully")
         handler.handle(body, signature)
-        print(f"Handler completed successfully")
     except InvalidSignatureError as e:
-        print(f"Invalid signature error: {str(e)}")
-        print(f"Body: {body[:200]}")
-        print(f"Signature: {signature}")
+        logger.warning("Invalid signature error: %s", e)
         abort(400)
     except Exception as e:
         # その他のエラーをログに出力
-        print(f"Error handling webhook: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error handling webhook: %s: %s", type(e).__name__, e)
         # LINE の検証リクエストの場合、イベントがなくてもエラーにならないよう 200 を返す
         return jsonify({'status': 'ok'})
+    finally:
+        # 返信後に投入したバックグラウンド処理をレスポンス前に完了させる
+        wait_background_tasks()
 
     return jsonify({'status': 'ok'})
 
@@ -672,47 +1217,27 @@ def webhook(request: Request):
 def handle_follow(event: FollowEvent):
     """友だち追加イベント処理"""
     line_user_id = event.source.user_id
-    configuration = get_configuration()
     engine = get_db_engine()
 
     # ユーザー情報を取得
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        profile = line_bot_api.get_profile(line_user_id)
+    line_bot_api = get_messaging_api()
+    profile = line_bot_api.get_profile(line_user_id)
 
-    # データベースにユーザー登録
-    user_id = None
-    is_new_user = False
-    with engine.connect() as conn:
-        # 既存ユーザーチェック
+    # データベースにユーザー登録（既存ユーザーはlast_login_atのみ更新）
+    # xmax = 0 の行は今回INSERTされた行（UPDATEされた行はxmaxが設定される）
+    with engine.begin() as conn:
         result = conn.execute(
-            sqlalchemy.text(
-                "SELECT id FROM users WHERE line_user_id = :line_user_id"
-            ),
-            {"line_user_id": line_user_id}
+            SQL_UPSERT_FOLLOWER,
+            {
+                "line_user_id": line_user_id,
+                "display_name": profile.display_name,
+                "last_login_at": datetime.now(timezone.utc)
+            }
         ).fetchone()
 
-        if not result:
-            # 新規ユーザー登録
-            is_new_user = True
-            result = conn.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO users (line_user_id, display_name, status, last_login_at)
-                    VALUES (:line_user_id, :display_name, 'active', :last_login_at)
-                    RETURNING id
-                    """
-                ),
-                {
-                    "line_user_id": line_user_id,
-                    "display_name": profile.display_name,
-                    "last_login_at": datetime.now(timezone.utc)
-                }
-            ).fetchone()
-            user_id = str(result[0])
-            conn.commit()
-        else:
-            user_id = str(result[0])
+    user_id = str(result[0])
+    is_new_user = result[1]
+    cache_user_id(line_user_id, result[0])
 
     # ウェルカムメッセージ（Pay It Forward機能統合）
     if is_new_user:
@@ -736,596 +1261,462 @@ def handle_follow(event: FollowEvent):
 
 まず、あなたと故人の関係を選択してください。"""
 
-    # Quick Reply（故人との関係）
-    quick_reply = QuickReply(
-        items=[
-            QuickReplyItem(action=MessageAction(label="父", text="父")),
-            QuickReplyItem(action=MessageAction(label="母", text="母")),
-            QuickReplyItem(action=MessageAction(label="配偶者", text="配偶者")),
-            QuickReplyItem(action=MessageAction(label="兄弟姉妹", text="兄弟姉妹")),
-            QuickReplyItem(action=MessageAction(label="祖父母", text="祖父母")),
-            QuickReplyItem(action=MessageAction(label="子", text="子")),
-            QuickReplyItem(action=MessageAction(label="その他", text="その他"))
-        ]
-    )
-
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=welcome_message, quick_reply=quick_reply)]
-            )
-        )
+    send_reply(event.reply_token, welcome_message, quick_reply=RELATIONSHIP_QUICK_REPLY)
 
 
 def handle_message(event: MessageEvent):
     """メッセージイベント処理"""
     line_user_id = event.source.user_id
     user_message = event.message.text
-    configuration = get_configuration()
     engine = get_db_engine()
 
-    # ユーザーのlast_login_atを更新
     with engine.connect() as conn:
-        conn.execute(
-            sqlalchemy.text(
-                """
-                UPDATE users
-                SET last_login_at = :last_login_at
-                WHERE line_user_id = :line_user_id
-                """
-            ),
-            {
-                "last_login_at": datetime.now(timezone.utc),
-                "line_user_id": line_user_id
-            }
-        )
-        conn.commit()
-
-        # ユーザー情報とプロフィール取得
-        user_data = conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT u.id, up.relationship, up.prefecture, up.municipality, up.death_date
-                FROM users u
-                LEFT JOIN user_profiles up ON u.id = up.user_id
-                WHERE u.line_user_id = :line_user_id
-                """
-            ),
-            {"line_user_id": line_user_id}
-        ).fetchone()
+        user_data = get_user_with_profile(line_user_id, conn)
 
     user_id = user_data[0]
 
     # ⭐ Phase 1: レート制限チェック
     # ただし、アップグレード関連メッセージと基本コマンドは除外
-    bypass_rate_limit_messages = ['アップグレード', '有料プラン', '課金', 'プラン変更', 'ヘルプ', '設定']
-    if user_message not in bypass_rate_limit_messages:
+    if get_message_command(user_message) not in RATE_LIMIT_EXEMPT_COMMANDS:
         is_limited, limit_message = is_rate_limited(str(user_id), engine)
         if is_limited:
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=limit_message)]
-                    )
-                )
+            send_reply(event.reply_token, limit_message)
             return  # レート制限超過のため処理終了
+
     relationship = user_data[1]
     prefecture = user_data[2]
     municipality = user_data[3]
     death_date = user_data[4]
 
-    # 会話履歴を保存
-    with engine.connect() as conn:
-        conn.execute(
-            sqlalchemy.text(
-                """
-                INSERT INTO conversation_history (user_id, role, message)
-                VALUES (:user_id, 'user', :message)
-                """
-            ),
-            {
-                "user_id": user_id,
-                "message": user_message
-            }
-        )
-        conn.commit()
-
     # プロフィール収集フロー
     reply_message = process_profile_collection(
         user_id, line_user_id, user_message, relationship, prefecture, municipality, death_date
     )
 
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-
-        # 返信メッセージの種類を判定
-        if isinstance(reply_message, list):
-            # 複数メッセージ（リスト）
-            messages = []
-            for msg in reply_message:
-                if isinstance(msg, dict):
-                    if msg.get("type") == "flex":
-                        messages.append(FlexMessage(alt_text=msg.get("altText", "メッセージ"), contents=FlexContainer.from_dict(msg["contents"])))
-                    else:
-                        # Flex Messageのコンテナ（bubble等）
-                        alt_text = "メッセージ"
-                        if msg.get("header", {}).get("contents"):
-                            header_text = msg["header"]["contents"][0].get("text", "")
-                            if header_text:
-                                alt_text = header_text.replace("📋 ", "").replace("⚙️ ", "")
-                        messages.append(FlexMessage(alt_text=alt_text, contents=FlexContainer.from_dict(msg)))
+    # 会話履歴の保存は返信処理と並行してバックグラウンドで行う
+    # AI応答を生成する場合は、保存の確定後にジョブを投入する（ワーカーが保存前の履歴を読まないようにする）
+    if isinstance(reply_message, dict) and reply_message.get("type") == "ai_response":
+        submit_background(save_user_message_and_enqueue_ai_response, user_id, line_user_id, user_message)
+        reply_message = reply_message["text"]
+    else:
+        submit_background(save_user_message, user_id, user_message)
+
+    # 返信メッセージの種類を判定
+    if isinstance(reply_message, list):
+        # 複数メッセージ（リスト）
+        messages = []
+        for msg in reply_message:
+            if isinstance(msg, dict):
+                if msg.get("type") == "flex":
+                    messages.append(FlexMessage(alt_text=msg.get("altText", "メッセージ"), contents=FlexContainer.from_dict(msg["contents"])))
                 else:
-                    # テキスト
-                    messages.append(TextMessage(text=str(msg)))
+                    # Flex Messageのコンテナ（bubble等）
+                    alt_text = "メッセージ"
+                    if msg.get("header", {}).get("contents"):
+                        header_text = msg["header"]["contents"][0].get("text", "")
+                        if header_text:
+                            alt_text = header_text.replace("📋 ", "").replace("⚙️ ", "")
+                    messages.append(FlexMessage(alt_text=alt_text, contents=FlexContainer.from_dict(msg)))
+            else:
+                # テキスト
+                messages.append(TextMessage(text=str(msg)))
 
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=messages
-                )
+        get_messaging_api().reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=messages
             )
-        elif isinstance(reply_message, dict):
-            if reply_message.get("type") == "text_with_quick_reply":
-                # Quick Reply付きテキストメッセージ
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(
-                            text=reply_message["text"],
-                            quick_reply=reply_message["quick_reply"]
-                        )]
-                    )
-                )
-            else:
-                # Flex Message
-                # alt_textをヘッダーテキストから取得（なければデフォルト）
-                alt_text = "メッセージ"
-                if reply_message.get("header", {}).get("contents"):
-                    header_text = reply_message["header"]["contents"][0].get("text", "")
-                    if header_text:
-                        alt_text = header_text.replace("📋 ", "").replace("⚙️ ", "")
-
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[FlexMessage(alt_text=alt_text, contents=FlexContainer.from_dict(reply_message))]
-                    )
-                )
+        )
+    elif isinstance(reply_message, dict):
+        if reply_message.get("type") == "text_with_quick_reply":
+            # Quick Reply付きテキストメッセージ
+            send_reply(event.reply_token, reply_message["text"], quick_reply=reply_message["quick_reply"])
         else:
-            # テキストメッセージ
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+            # Flex Message
+            # alt_textをヘッダーテキストから取得（なければデフォルト）
+            alt_text = "メッセージ"
+            if reply_message.get("header", {}).get("contents"):
+                header_text = reply_message["header"]["contents"][0].get("text", "")
+                if header_text:
+                    alt_text = header_text.replace("📋 ", "").replace("⚙️ ", "")
+
+            send_reply(event.reply_token, reply_message, alt_text=alt_text)
+    else:
+        # テキストメッセージ
+        send_reply(event.reply_token, reply_message)
 
 
-def process_profile_collection(user_id, line_user_id, message, relationship, prefecture, municipality, death_date):
-    """プロフィール収集処理"""
-    engine = get_db_engine()
+def insert_manual_task(conn, user_id, title: str, due_date=None):
+    """
+    手動で追加されたタスクを末尾に追加（コミットは呼び出し元で行う）
 
-    # 追加質問回答待ち状態のチェック
-    with engine.connect() as conn:
-        flow_manager = ConversationFlowManager(conn)
-        current_state = flow_manager.get_current_state(user_id)
-
-        # 追加質問回答待ち状態の場合
-        if current_state == 'awaiting_follow_up_answers':
-            # 未回答の質問を取得
-            questions = get_unanswered_questions(user_id, conn)
-
-            if questions:
-                # 最初の未回答質問に対する回答として保存
-                first_question = questions[0]
-                save_answer(user_id, first_question['question_key'], message, conn)
-
-                # まだ未回答の質問があるか確認
-                remaining_questions = get_unanswered_questions(user_id, conn)
-
-                if remaining_questions:
-                    # 次の質問を送信
-                    next_question = remaining_questions[0]
-                    question_message = format_question_for_line(next_question)
-
-                    quick_reply = QuickReply(
-                        items=[
-                            QuickReplyItem(action=MessageAction(label="はい", text="はい")),
-                            QuickReplyItem(action=MessageAction(label="いいえ", text="いいえ"))
-                        ]
-                    )
+    同じユーザーのタスク追加が同時に実行されても order_index が重複しないよう、
+    ユーザー単位のロックを取ってから採番する
+    """
+    conn.execute(SQL_ADVISORY_XACT_LOCK, {"lock_key": f"manual-task:{user_id}"})
+    conn.execute(
+        SQL_INSERT_MANUAL_TASK,
+        {
+            "user_id": user_id,
+            "title": title,
+            "description": "手動で追加されたタスク",
+            "category": "その他",
+            "priority": "medium",
+            "due_date": due_date
+        }
+    )
 
-                    return {
-                        "type": "text_with_quick_reply",
-                        "text": question_message,
-                        "quick_reply": quick_reply
-                    }
-                else:
-                    # すべての質問に回答完了
-                    # Step 2: 個別タスク生成を開始
-                    flow_manager.clear_state(user_id, 'awaiting_follow_up_answers')
 
-                    # Cloud Tasksに個別タスク生成ジョブを投入
-                    enqueue_personalized_task_generation(user_id, line_user_id)
+def get_message_command(message: str):
+    """メッセージに対応するコマンド名を取得（前後の空白と大文字・小文字の違いは無視する）"""
+    return MESSAGE_COMMANDS.get(message.strip().casefold())
+
+
+def _flow_follow_up_answers(conn, user_id, line_user_id: str, message: str, state):
+    """追加質問への回答を保存し、次の質問または個別タスク生成の開始を返す"""
+    # 未回答の質問を取得
+    questions = get_unanswered_questions(user_id, conn)
+
+    if questions:
+        # 最初の未回答質問に対する回答として保存
+        first_question = questions[0]
+        save_answer(user_id, first_question['question_key'], message, conn)
+
+        # まだ未回答の質問があるか確認
+        remaining_questions = get_unanswered_questions(user_id, conn)
+
+        if remaining_questions:
+            # 次の質問を送信
+            next_question = remaining_questions[0]
+            question_message = format_question_for_line(next_question)
+
+            return {
+                "type": "text_with_quick_reply",
+                "text": question_message,
+                "quick_reply": YES_NO_QUICK_REPLY
+            }
+        else:
+            # すべての質問に回答完了
+            # Step 2: 個別タスク生成を開始
+            ConversationFlowManager(conn).clear_state(user_id, 'awaiting_follow_up_answers')
+
+            # Cloud Tasksに個別タスク生成ジョブを投入
+            submit_background(enqueue_personalized_task_generation, user_id, line_user_id)
 
-                    return """✅ 質問へのご回答ありがとうございました！
+            return """✅ 質問へのご回答ありがとうございました！
 
 🤖 あなたの状況に特化した追加タスクを生成中です...
 
 ⏱️ 完了したら通知でお知らせします。"""
 
-    # 編集モードのチェック
-    with engine.connect() as conn:
-        last_system_message = conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT message
-                FROM conversation_history
-                WHERE user_id = :user_id AND role = 'system'
-                ORDER BY created_at DESC
-                LIMIT 1
-                """
-            ),
-            {"user_id": user_id}
-        ).fetchone()
 
-        # タスク追加フローのチェック
-        if last_system_message and last_system_message[0].startswith('adding_task:'):
-            parts = last_system_message[0].split(':')
-            adding_step = parts[1]
+def _flow_adding_task(conn, user_id, line_user_id: str, message: str, state: str):
+    """タスク追加フロー（タイトル入力 → 期限選択）"""
+    parts = state.split(':')
+    adding_step = parts[1]
 
-            # フラグをクリア
-            conn.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM conversation_history
-                    WHERE user_id = :user_id AND role = 'system' AND message LIKE 'adding_task:%'
-                    """
-                ),
-                {"user_id": user_id}
-            )
-            conn.commit()
+    # フラグをクリア（後続の書き込みと同じトランザクションで確定する）
+    conn.execute(
+        SQL_CLEAR_FLOW_STATE,
+        {"user_id": user_id, "pattern": "adding_task:%"}
+    )
 
-            if adding_step == 'title':
-                # タイトル入力後、期限選択へ
-                task_title = message
+    if adding_step == 'title':
+        # タイトル入力後、期限選択へ
+        task_title = message
 
-                # タイトルを一時保存
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        INSERT INTO conversation_history (user_id, role, message)
-                        VALUES (:user_id, 'system', :data)
-                        """
-                    ),
-                    {"user_id": user_id, "data": f"adding_task:due_date:{task_title}"}
-                )
-                conn.commit()
+        # タイトルを一時保存
+        conn.execute(
+            SQL_SET_FLOW_STATE,
+            {"user_id": user_id, "data": f"adding_task:due_date:{task_title}"}
+        )
+        conn.commit()
 
-                return {
-                    "type": "text_with_quick_reply",
-                    "text": f"タスク「{task_title}」の期限を選択してください",
-                    "quick_reply": QuickReply(
-                        items=[
-                            QuickReplyItem(
-                                action=DatetimePickerAction(
-                                    label="📅 期限を選択",
-                                    data="action=add_task_due_date",
-                                    mode="date"
-                                )
-                            ),
-                            QuickReplyItem(
-                                action=MessageAction(label="期限なし", text="期限なし")
-                            )
-                        ]
-                    )
-                }
+        return {
+            "type": "text_with_quick_reply",
+            "text": f"タスク「{task_title}」の期限を選択してください",
+            "quick_reply": TASK_DUE_DATE_QUICK_REPLY
+        }
 
-            elif adding_step == 'due_date':
-                # 期限「なし」が選択された場合
-                if message == "期限なし":
-                    # タイトルを取得
-                    if len(parts) >= 3:
-                        task_title = ':'.join(parts[2:])
-
-                        # タスクを追加（期限なし）
-                        max_order = conn.execute(
-                            sqlalchemy.text("SELECT COALESCE(MAX(order_index), 0) FROM tasks WHERE user_id = :user_id"),
-                            {"user_id": user_id}
-                        ).scalar()
-
-                        conn.execute(
-                            sqlalchemy.text(
-                                """
-                                INSERT INTO tasks (user_id, title, description, category, priority, status, order_index)
-                                VALUES (:user_id, :title, :description, :category, :priority, 'pending', :order_index)
-                                """
-                            ),
-                            {
-                                "user_id": user_id,
-                                "title": task_title,
-                                "description": "手動で追加されたタスク",
-                                "category": "その他",
-                                "priority": "medium",
-                                "order_index": max_order + 1
-                            }
-                        )
-                        conn.commit()
-
-                        return f"✅ タスク「{task_title}」を追加しました"
-                    else:
-                        return "エラーが発生しました。もう一度お試しください。"
-
-        # 編集フローのチェック
-        if last_system_message and last_system_message[0].startswith('editing:'):
-            editing_field = last_system_message[0].split(':')[1]
-
-            # 編集フラグをクリア
-            conn.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM conversation_history
-                    WHERE user_id = :user_id AND role = 'system' AND message LIKE 'editing:%'
-                    """
-                ),
-                {"user_id": user_id}
-            )
-            conn.commit()
+    elif adding_step == 'due_date':
+        # 期限「なし」が選択された場合
+        if message == "期限なし":
+            # タイトルを取得
+            if len(parts) >= 3:
+                task_title = ':'.join(parts[2:])
 
-            # 各フィールドの更新処理
-            if editing_field == 'relationship':
-                # 故人との関係を更新
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        UPDATE user_profiles
-                        SET relationship = :relationship
-                        WHERE user_id = :user_id
-                        """
-                    ),
-                    {"user_id": user_id, "relationship": message}
-                )
+                # タスクを追加（期限なし）
+                insert_manual_task(conn, user_id, task_title)
                 conn.commit()
-                return f"✅ 故人との関係を「{message}」に変更しました"
 
-            elif editing_field == 'prefecture':
-                # 都道府県選択後、市区町村入力へ
-                # 都道府県を一時保存
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        DELETE FROM conversation_history
-                        WHERE user_id = :user_id AND role = 'system' AND message LIKE 'editing:%'
-                        """
-                    ),
-                    {"user_id": user_id}
-                )
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        INSERT INTO conversation_history (user_id, role, message)
-                        VALUES (:user_id, 'system', :prefecture_data)
-                        """
-                    ),
-                    {"user_id": user_id, "prefecture_data": f"editing:municipality:{message}"}
-                )
+                return f"✅ タスク「{task_title}」を追加しました"
+            else:
                 conn.commit()
+                return "エラーが発生しました。もう一度お試しください。"
 
-                return f"{message}の市区町村名を入力してください。\n\n例：新宿区、横浜市"
-
-            elif editing_field == 'municipality':
-                # 市区町村入力（都道府県はconversation_historyに保存済み）
-                # 都道府県を取得
-                parts = last_system_message[0].split(':')
-                if len(parts) >= 3:
-                    stored_prefecture = parts[2]
-
-                    conn.execute(
-                        sqlalchemy.text(
-                            """
-                            UPDATE user_profiles
-                            SET prefecture = :prefecture, municipality = :municipality
-                            WHERE user_id = :user_id
-                            """
-                        ),
-                        {"user_id": user_id, "prefecture": stored_prefecture, "municipality": message}
-                    )
-                    conn.commit()
+    # 書き込みのない経路でもフラグのクリアは確定する
+    conn.commit()
 
-                    # タスク再生成確認
-                    return {
-                        "type": "bubble",
-                        "body": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "text",
-                                    "text": f"✅ お住まいを「{stored_prefecture} {message}」に変更しました",
-                                    "wrap": True,
-                                    "weight": "bold",
-                                    "color": "#17C964"
-                                },
-                                {
-                                    "type": "text",
-                                    "text": "住所が変わると、窓口情報や手続き内容が変わる可能性があります。タスクを再生成しますか？",
-                                    "wrap": True,
-                                    "margin": "lg",
-                                    "size": "sm"
-                                }
-                            ]
-                        },
-                        "footer": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "postback",
-                                        "label": "タスクを再生成",
-                                        "data": "action=regenerate_tasks",
-                                        "displayText": "タスクを再生成"
-                                    },
-                                    "style": "primary",
-                                    "color": "#17C964"
-                                },
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "message",
-                                        "label": "このまま",
-                                        "text": "設定"
-                                    },
-                                    "style": "link",
-                                    "margin": "sm"
-                                }
-                            ]
-                        }
-                    }
-                else:
-                    return "エラーが発生しました。もう一度お試しください。"
 
-        elif last_system_message and last_system_message[0].startswith('editing_memo:'):
-            # メモ編集処理
-            task_id = last_system_message[0].split(':')[1]
+def _flow_editing(conn, user_id, line_user_id: str, message: str, state: str):
+    """プロフィール編集フロー（故人との関係・お住まい）"""
+    editing_field = state.split(':')[1]
 
-            # 編集フラグをクリア
-            conn.execute(
-                sqlalchemy.text(
-                    """
-                    DELETE FROM conversation_history
-                    WHERE user_id = :user_id AND role = 'system' AND message LIKE 'editing_memo:%'
-                    """
-                ),
-                {"user_id": user_id}
-            )
-            conn.commit()
+    # 編集フラグをクリア（後続の書き込みと同じトランザクションで確定する）
+    conn.execute(
+        SQL_CLEAR_FLOW_STATE,
+        {"user_id": user_id, "pattern": "editing:%"}
+    )
+
+    # 各フィールドの更新処理
+    if editing_field == 'relationship':
+        # 故人との関係を更新
+        conn.execute(
+            sqlalchemy.text(
+                """
+                UPDATE user_profiles
+                SET relationship = :relationship
+                WHERE user_id = :user_id
+                """
+            ),
+            {"user_id": user_id, "relationship": message}
+        )
+        conn.commit()
+        return f"✅ 故人との関係を「{message}」に変更しました"
 
-            # メモを保存
-            import json
-            memo_text = message.strip()
+    elif editing_field == 'prefecture':
+        # 都道府県選択後、市区町村入力へ
+        # 都道府県を一時保存（編集フラグは上で削除済み）
+        conn.execute(
+            SQL_SET_FLOW_STATE,
+            {"user_id": user_id, "data": f"editing:municipality:{message}"}
+        )
+        conn.commit()
 
-            # メモ削除キーワードのチェック（Issue #16対応）
-            delete_keywords = ['削除', 'なし', 'クリア', '消す', 'delete', 'clear', 'none']
-            is_delete = memo_text.lower() in delete_keywords
+        return f"{message}の市区町村名を入力してください。\n\n例：新宿区、横浜市"
 
-            if memo_text and not is_delete:
-                # メモがある場合は保存
-                metadata = json.dumps({"memo": memo_text})
-            else:
-                # 削除キーワードまたは空白の場合はメモを削除
-                metadata = json.dumps({"memo": ""})
+    elif editing_field == 'municipality':
+        # 市区町村入力（都道府県はconversation_historyに保存済み）
+        # 都道府県を取得
+        parts = state.split(':')
+        if len(parts) >= 3:
+            stored_prefecture = parts[2]
 
             conn.execute(
                 sqlalchemy.text(
                     """
-                    UPDATE tasks
-                    SET metadata = CAST(:metadata AS jsonb)
-                    WHERE id = :task_id AND user_id = :user_id
+                    UPDATE user_profiles
+                    SET prefecture = :prefecture, municipality = :municipality
+                    WHERE user_id = :user_id
                     """
                 ),
-                {"task_id": task_id, "user_id": user_id, "metadata": metadata}
+                {"user_id": user_id, "prefecture": stored_prefecture, "municipality": message}
             )
             conn.commit()
 
-            # 成功メッセージとタスク詳細を返す
-            task_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT id, title, description, due_date, priority, category, metadata
-                    FROM tasks
-                    WHERE id = :task_id AND user_id = :user_id
-                    """
-                ),
-                {"task_id": task_id, "user_id": user_id}
-            ).fetchone()
+            # タスク再生成確認
+            return _regenerate_tasks_confirm(
+                f"✅ お住まいを「{stored_prefecture} {message}」に変更しました",
+                _ADDRESS_CHANGED_NOTICE
+            )
+        else:
+            conn.commit()
+            return "エラーが発生しました。もう一度お試しください。"
 
-            if task_data:
-                from flex_messages import create_task_detail_flex
-                success_message = "✅ メモを保存しました" if (memo_text and not is_delete) else "✅ メモを削除しました"
-                return [
-                    success_message,
-                    {
-                        "type": "flex",
-                        "altText": "タスク詳細",
-                        "contents": create_task_detail_flex(task_data)
-                    }
-                ]
-            else:
-                return "タスクが見つかりません。"
+    # テキスト入力で更新しないフィールド（死亡日はDatetimepickerで更新）はフラグのクリアのみ確定
+    conn.commit()
+
+
+def _flow_editing_memo(conn, user_id, line_user_id: str, message: str, state: str):
+    """タスクのメモ編集フロー"""
+    # メモ編集処理
+    task_id = state.split(':')[1]
+
+    # 編集フラグをクリア（メモの更新と同じトランザクションで確定する）
+    conn.execute(
+        SQL_CLEAR_FLOW_STATE,
+        {"user_id": user_id, "pattern": "editing_memo:%"}
+    )
+
+    # メモを保存
+    memo_text = message.strip()
+
+    # メモ削除キーワードのチェック（Issue #16対応）
+    is_delete = memo_text.lower() in MEMO_DELETE_KEYWORDS
+
+    if memo_text and not is_delete:
+        # メモがある場合は保存
+        metadata = json.dumps({"memo": memo_text})
+    else:
+        # 削除キーワードまたは空白の場合はメモを削除
+        metadata = json.dumps({"memo": ""})
+
+    # メモを更新し、タスク詳細の表示に使う行を同じ往復で受け取る
+    task_data = conn.execute(
+        sqlalchemy.text(
+            """
+            UPDATE tasks
+            SET metadata = CAST(:metadata AS jsonb)
+            WHERE id = :task_id AND user_id = :user_id
+            RETURNING id, title, description, due_date, priority, category, metadata
+            """
+        ),
+        {"task_id": task_id, "user_id": user_id, "metadata": metadata}
+    ).fetchone()
+    conn.commit()
+
+    # 成功メッセージとタスク詳細を返す
+    if task_data is not None:
+        success_message = "✅ メモを保存しました" if (memo_text and not is_delete) else "✅ メモを削除しました"
+        return [
+            success_message,
+            {
+                "type": "flex",
+                "altText": "タスク詳細",
+                "contents": create_task_detail_flex(task_data)
+            }
+        ]
+    else:
+        return "タスクが見つかりません。"
+
+
+def _command_help(user_id, line_user_id: str, profile: tuple):
+    """ヘルプを表示"""
+    return get_help_message()
+
+
+def _command_settings(user_id, line_user_id: str, profile: tuple):
+    """設定（プロフィールとプラン）を表示"""
+    return get_settings_message(user_id, *profile)
+
+
+def _command_upgrade(user_id, line_user_id: str, profile: tuple):
+    """有料プランへのアップグレードを案内"""
+    return handle_upgrade_request(user_id, line_user_id)
+
+
+# プロフィールの入力状況によらず実行できるコマンドの処理
+COMMAND_HANDLERS = {
+    'help': _command_help,
+    'settings': _command_settings,
+    'upgrade': _command_upgrade,
+}
+
+
+def _task_command_list(conn, user_id):
+    """未完了タスクの一覧を表示"""
+    return get_task_list_message(user_id, conn=conn)
+
+
+def _task_command_all(conn, user_id):
+    """全タスクの一覧を表示"""
+    return get_task_list_message(user_id, show_all=True, conn=conn)
+
+
+def _task_command_add(conn, user_id):
+    """タスク追加フローを開始"""
+    conn.execute(
+        SQL_SET_FLOW_STATE,
+        {"user_id": user_id, "data": "adding_task:title"}
+    )
+    conn.commit()
+    return "追加するタスクのタイトルを入力してください"
+
+
+# タスク生成済みのユーザーのみ実行できるコマンドの処理
+TASK_COMMAND_HANDLERS = {
+    'task_list': _task_command_list,
+    'all_tasks': _task_command_all,
+    'add_task': _task_command_add,
+}
+
+
+# 入力フローの種類ごとの処理（会話状態名、またはフロー状態フラグの接頭辞で引く）
+# 各処理は返信を返し、返信がない（None）場合は通常のメッセージとして処理を続ける
+FLOW_HANDLERS = {
+    'awaiting_follow_up_answers': _flow_follow_up_answers,
+    'adding_task': _flow_adding_task,
+    'editing': _flow_editing,
+    'editing_memo': _flow_editing_memo,
+}
+
+
+def process_profile_collection(user_id, line_user_id, message, relationship, prefecture, municipality, death_date):
+    """プロフィール収集処理"""
+    engine = get_db_engine()
+    command = get_message_command(message)
+    # 入力フローの処理では同じ接続を使う（各ヘルパーにも同じ接続を渡す）
+    with engine.connect() as conn:
+        # 追加質問回答待ち状態のチェック
+        current_state = ConversationFlowManager(conn).get_current_state(user_id)
+        flow_handler = FLOW_HANDLERS.get(current_state)
+        if flow_handler:
+            reply = flow_handler(conn, user_id, line_user_id, message, None)
+            if reply is not None:
+                return reply
+
+        # 編集モードのチェック
+        last_system_message = conn.execute(
+            SQL_GET_LAST_FLOW_STATE,
+            {"user_id": user_id}
+        ).fetchone()
+
+        # 進行中の入力フロー（'adding_task' / 'editing' / 'editing_memo'）の処理
+        if last_system_message:
+            state = last_system_message[0]
+            flow_handler = FLOW_HANDLERS.get(state.split(':', 1)[0])
+            if flow_handler:
+                reply = flow_handler(conn, user_id, line_user_id, message, state)
+                if reply is not None:
+                    return reply
 
     # ヘルプと設定は常に表示可能
-    if message == 'ヘルプ':
-        return get_help_message()
-    elif message == '設定':
-        return get_settings_message(user_id, relationship, prefecture, municipality, death_date)
-    elif message in ['アップグレード', '有料プラン', '課金', 'プラン変更']:
-        return handle_upgrade_request(user_id, line_user_id)
-
-    # プロフィールが全て揃っている場合
-    if relationship and prefecture and municipality and death_date:
-        # 既にタスクが生成されているかチェック
-        with engine.connect() as conn:
-            task_count = conn.execute(
+    # （設定・アップグレードは別の接続やStripe APIを使うため、入力フローの接続を返却してから処理する）
+    command_handler = COMMAND_HANDLERS.get(command)
+    if command_handler:
+        return command_handler(user_id, line_user_id, (relationship, prefecture, municipality, death_date))
+
+    with engine.connect() as conn:
+        # プロフィールが全て揃っている場合
+        if relationship and prefecture and municipality and death_date:
+            # 既にタスクが生成されているかチェック（1件見つかった時点で打ち切る）
+            has_tasks = conn.execute(
                 sqlalchemy.text(
-                    "SELECT COUNT(*) FROM tasks WHERE user_id = :user_id AND is_deleted = false"
+                    "SELECT EXISTS (SELECT 1 FROM tasks WHERE user_id = :user_id AND is_deleted = false)"
                 ),
                 {"user_id": user_id}
             ).scalar()
 
-            if task_count > 0:
+            if has_tasks:
                 # タスク生成済み - タスク一覧表示 or タスク完了 or AI会話モード
-                if message in ['タスク', 'タスク一覧', 'タスクリスト', 'todo', 'TODO']:
-                    return get_task_list_message(user_id)
-                elif message == '全タスク':
-                    return get_task_list_message(user_id, show_all=True)
-                elif message in ['タスク追加', 'タスク追加', '追加']:
-                    # タスク追加フローを開始
-                    with engine.connect() as conn:
-                        conn.execute(
-                            sqlalchemy.text(
-                                """
-                                INSERT INTO conversation_history (user_id, role, message)
-                                VALUES (:user_id, 'system', 'adding_task:title')
-                                """
-                            ),
-                            {"user_id": user_id}
-                        )
-                        conn.commit()
-                    return "追加するタスクのタイトルを入力してください"
-                elif message == 'ヘルプ':
-                    return get_help_message()
-                elif message == '設定':
-                    return get_settings_message(user_id, relationship, prefecture, municipality, death_date)
+                task_command_handler = TASK_COMMAND_HANDLERS.get(command)
+                if task_command_handler:
+                    return task_command_handler(conn, user_id)
                 elif '完了' in message and any(c.isdigit() or c in '０１２３４５６７８９' for c in message):
                     # 「完了1」「1完了」「完了１」「１完了」などのパターンをチェック
-                    return complete_task(user_id, message)
+                    return complete_task(user_id, message, conn=conn)
                 else:
-                    # AI応答を非同期で生成（Cloud Tasksキュー経由）
-                    enqueue_ai_response_generation(user_id, line_user_id, message)
-                    return "AIが応答を考えています...\nしばらくお待ちください"
+                    # AI応答を非同期で生成（Cloud Tasksキュー経由、投入は呼び出し元で会話履歴の保存後に行う）
+                    return {
+                        "type": "ai_response",
+                        "text": "AIが応答を考えています...\nしばらくお待ちください"
+                    }
             else:
                 # タスク生成をCloud Tasksに投入（非同期）
-                enqueue_task_generation(user_id, line_user_id)
+                submit_background(enqueue_task_generation, user_id, line_user_id)
 
                 return f"""✅ プロフィール登録が完了しました
 
 🤖 AIがあなた専用のタスクを生成中です...
 
 📍 {prefecture}{municipality}での手続き情報
-📅 死亡日: {death_date.strftime('%Y年%m月%d日') if hasattr(death_date, 'strftime') else str(death_date)}
+📅 死亡日: {format_date_ja(death_date) if hasattr(death_date, 'year') else str(death_date)}
 
 ⏱️ 生成には5分程度かかります。完了したら通知でお知らせします。
 
 しばらくお待ちください。"""
 
-    # プロフィール収集中
-    with engine.connect() as conn:
+        # プロフィール収集中
         if not relationship:
             # プロフィールが存在するかチェック
             profile_exists = conn.execute(
@@ -1360,27 +1751,10 @@ def process_profile_collection(user_id, line_user_id, message, relationship, pre
                 )
             conn.commit()
 
-            # 都道府県選択用のQuick Reply
-            prefecture_quick_reply = QuickReply(
-                items=[
-                    QuickReplyItem(action=MessageAction(label="東京都", text="東京都")),
-                    QuickReplyItem(action=MessageAction(label="大阪府", text="大阪府")),
-                    QuickReplyItem(action=MessageAction(label="神奈川県", text="神奈川県")),
-                    QuickReplyItem(action=MessageAction(label="愛知県", text="愛知県")),
-                    QuickReplyItem(action=MessageAction(label="埼玉県", text="埼玉県")),
-                    QuickReplyItem(action=MessageAction(label="千葉県", text="千葉県")),
-                    QuickReplyItem(action=MessageAction(label="兵庫県", text="兵庫県")),
-                    QuickReplyItem(action=MessageAction(label="福岡県", text="福岡県")),
-                    QuickReplyItem(action=MessageAction(label="北海道", text="北海道")),
-                    QuickReplyItem(action=MessageAction(label="京都府", text="京都府")),
-                    QuickReplyItem(action=MessageAction(label="その他", text="その他"))
-                ]
-            )
-
             return {
                 "type": "text_with_quick_reply",
                 "text": "ありがとうございます。\n\n次に、お住まいの都道府県を選択してください。\n（一覧にない場合は直接入力してください）",
-                "quick_reply": prefecture_quick_reply
+                "quick_reply": PREFECTURE_QUICK_REPLY
             }
 
         elif not prefecture:
@@ -1416,19 +1790,7 @@ def process_profile_collection(user_id, line_user_id, message, relationship, pre
             conn.commit()
 
             # 死亡日選択用のDatetimepicker Quick Reply
-            today = datetime.now().date()
-
-            death_date_quick_reply = QuickReply(
-                items=[
-                    QuickReplyItem(action=DatetimePickerAction(
-                        label="日付を選択",
-                        data="action=set_death_date",
-                        mode="date",
-                        initial=today.isoformat(),
-                        max=today.isoformat()
-                    ))
-                ]
-            )
+            death_date_quick_reply = get_death_date_quick_reply(datetime.now().date().isoformat())
 
             return {
                 "type": "text_with_quick_reply",
@@ -1454,14 +1816,14 @@ def process_profile_collection(user_id, line_user_id, message, relationship, pre
                 conn.commit()
 
                 # タスク生成をCloud Tasksに投入（非同期）
-                enqueue_task_generation(user_id, line_user_id)
+                submit_background(enqueue_task_generation, user_id, line_user_id)
 
                 return f"""✅ プロフィール登録が完了しました
 
 🤖 AIがあなた専用のタスクを生成中です...
 
 📍 {prefecture or '（未設定）'}{municipality or '（未設定）'}での手続き情報
-📅 死亡日: {death_dt.strftime('%Y年%m月%d日')}
+📅 死亡日: {format_date_ja(death_dt)}
 
 ⏱️ 生成には5分程度かかります。完了したら通知でお知らせします。
 
@@ -1471,91 +1833,47 @@ def process_profile_collection(user_id, line_user_id, message, relationship, pre
                 return "日付の形式が正しくありません。\nYYYY-MM-DD形式で入力してください。\n（例：2024-01-15）"
 
 
-def get_task_list_message(user_id: str, show_all: bool = False):
-    """タスク一覧をFlex Messageで返す"""
-    engine = get_db_engine()
-
-    with engine.connect() as conn:
-        tasks = conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT id, title, due_date, status, priority, category, metadata
-                FROM tasks
-                WHERE user_id = :user_id
-                ORDER BY
-                    CASE status
-                        WHEN 'pending' THEN 1
-                        WHEN 'in_progress' THEN 2
-                        ELSE 3
-                    END,
-                    due_date ASC
-                """
-            ),
-            {"user_id": user_id}
-        ).fetchall()
+def get_task_list_message(user_id: str, show_all: bool = False, conn=None):
+    """タスク一覧をFlex Messageで返す（conn指定時は呼び出し元の接続を使う）"""
+    if conn is None:
+        with get_db_engine().connect() as conn:
+            return get_task_list_message(user_id, show_all, conn)
+
+    tasks = conn.execute(
+        sqlalchemy.text(
+            """
+            SELECT id, title, due_date, status, priority, category, metadata
+            FROM tasks
+            WHERE user_id = :user_id
+            ORDER BY (status <> 'pending'), (status <> 'in_progress'), due_date ASC
+            """
+        ),
+        {"user_id": user_id}
+    ).fetchall()
 
     # ⭐ Phase 1: プラン制御 - タスクをプランに応じてフィルタリング
-    print(f"📊 Phase 1: タスク数（フィルタリング前）: {len(tasks)}")
-
-    plan_controller = get_plan_controller()
-    tasks_as_dict = [
-        {
-            "id": str(task[0]),
-            "title": task[1],
-            "due_date": task[2],
-            "status": task[3],
-            "priority": task[4],
-            "category": task[5],
-            "metadata": task[6]
-        }
-        for task in tasks
-    ]
-
-    print(f"🔐 Phase 1: プラン制御を実行 (user_id: {user_id})")
-    filtered_tasks_dict = plan_controller.filter_tasks_by_plan(str(user_id), tasks_as_dict)
-    print(f"📊 Phase 1: タスク数（フィルタリング後）: {len(filtered_tasks_dict)}")
+    # （行はcreate_task_list_flexが期待するタプル形式のまま渡す）
+    logger.debug("📊 Phase 1: タスク数（フィルタリング前）: %d", len(tasks))
 
-    # 辞書形式をタプル形式に戻す（create_task_list_flexがタプルを期待しているため）
-    filtered_tasks = [
-        (
-            task["id"],
-            task["title"],
-            task["due_date"],
-            task["status"],
-            task["priority"],
-            task["category"],
-            task["metadata"]
-        )
-        for task in filtered_tasks_dict
-    ]
+    logger.debug("🔐 Phase 1: プラン制御を実行 (user_id: %s)", user_id)
+    filtered_tasks = get_plan_controller().filter_tasks_by_plan(str(user_id), tasks)
+    logger.debug("📊 Phase 1: タスク数（フィルタリング後）: %d", len(filtered_tasks))
 
     # Flex Messageを返す（フィルタリング済みタスク）
     return create_task_list_flex(filtered_tasks, show_all=show_all)
 
 
-def complete_task(user_id: str, message: str) -> str:
-    """タスクを完了にする"""
-    engine = get_db_engine()
-
-    # タスク番号を抽出（様々なパターンに対応）
-    import re
-
-    # 全角数字を半角に変換
-    def normalize_number(text):
-        zen_to_han = str.maketrans('０１２３４５６７８９', '0123456789')
-        return text.translate(zen_to_han)
-
-    normalized_msg = normalize_number(message)
-
-    # 「完了1」「完了 1」「1完了」「1 完了」などのパターンに対応
-    patterns = [
-        r'完了[\s　]*(\d+)',  # 完了1, 完了 1, 完了　1
-        r'(\d+)[\s　]*完了',  # 1完了, 1 完了, 1　完了
-    ]
+def complete_task(user_id: str, message: str, conn=None) -> str:
+    """タスクを完了にする（conn指定時は呼び出し元の接続を使う）"""
+    if conn is None:
+        with get_db_engine().connect() as conn:
+            return complete_task(user_id, message, conn)
 
+    # タスク番号を抽出（全角数字は半角に変換してから照合）
+    normalized_msg = message.translate(_ZEN_TO_HAN)
     task_num = None
-    for pattern in patterns:
-        match = re.search(pattern, normalized_msg)
+    for pattern in _COMPLETE_TASK_PATTERNS:
+        match = pattern.search(normalized_msg)
         if match:
             task_num = int(match.group(1))
             break
@@ -1564,95 +1882,99 @@ def complete_task(user_id: str, message: str) -> str:
         return "タスク番号が正しくありません。\n「完了1」または「1完了」のように番号を指定してください。"
 
     # 未完了タスクを取得（番号順）
-    with engine.connect() as conn:
-        pending_tasks = conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT id, title
-                FROM tasks
-                WHERE user_id = :user_id AND is_deleted = false AND status = 'pending'
-                ORDER BY due_date ASC
-                """
-            ),
-            {"user_id": user_id}
-        ).fetchall()
+    pending_tasks = conn.execute(
+        sqlalchemy.text(
+            """
+            SELECT id, title
+            FROM tasks
+            WHERE user_id = :user_id AND is_deleted = false AND status = 'pending'
+            ORDER BY due_date ASC
+            """
+        ),
+        {"user_id": user_id}
+    ).fetchall()
+
+    if not pending_tasks:
+        return "完了可能なタスクがありません。"
+
+    if task_num < 1 or task_num > len(pending_tasks):
+        return f"タスク番号は1〜{len(pending_tasks)}の範囲で指定してください。"
+
+    # 指定されたタスクを完了にする
+    task_id, task_title = pending_tasks[task_num - 1]
+
+    conn.execute(
+        SQL_SET_TASK_STATUS,
+        {
+            "task_id": task_id,
+            "user_id": user_id,
+            "status": "completed",
+            "completed_at": datetime.now(timezone.utc)
+        }
+    )
+    conn.commit()
 
-        if not pending_tasks:
-            return "完了可能なタスクがありません。"
+    return f"✅ 「{task_title}」を完了しました！\n\n他のタスクを確認するには「タスク」と送信してください。"
 
-        if task_num < 1 or task_num > len(pending_tasks):
-            return f"タスク番号は1〜{len(pending_tasks)}の範囲で指定してください。"
 
-        # 指定されたタスクを完了にする
-        task_id, task_title = pending_tasks[task_num - 1]
+def _first_chunk_end(text: str):
+    """先行送信する冒頭部分の終端位置を返す（まだ確定しない場合はNone）"""
+    for i, c in enumerate(text[:FIRST_CHUNK_MAX_CHARS]):
+        if c in '。\n' and text[:i].strip():
+            return i + 1
+    if len(text) >= FIRST_CHUNK_MAX_CHARS:
+        return FIRST_CHUNK_MAX_CHARS
+    return None
 
-        conn.execute(
-            sqlalchemy.text(
-                """
-                UPDATE tasks
-                SET status = 'completed'
-                WHERE id = :task_id AND user_id = :user_id
-                """
-            ),
-            {"task_id": task_id, "user_id": user_id}
-        )
 
-        # task_progressに記録
-        conn.execute(
-            sqlalchemy.text(
-                """
-                INSERT INTO task_progress (task_id, status, completed_at)
-                VALUES (:task_id, 'completed', :completed_at)
-                """
-            ),
-            {
-                "task_id": task_id,
-                "completed_at": datetime.now(timezone.utc)
-            }
-        )
+def select_ai_model(user_message: str, knowledge: str) -> str:
+    """
+    AI応答に使うモデルを選択
 
-        conn.commit()
+    ナレッジベースに該当がある質問や長いメッセージは高精度モデル、
+    それ以外の短いメッセージ（お礼・相槌など）は軽量モデルで応答する
 
-    return f"✅ 「{task_title}」を完了しました！\n\n他のタスクを確認するには「タスク」と送信してください。"
+    Args:
+        user_message: ユーザーのメッセージ
+        knowledge: search_knowledgeの結果
 
+    Returns:
+        モデル名
+    """
+    if knowledge or len(user_message) > AI_LIGHT_MESSAGE_MAX_CHARS:
+        return AI_MODEL_HEAVY
+    return AI_MODEL_LIGHT
+
+
+def generate_ai_response(user_id: str, user_message: str, on_first_chunk=None) -> str:
+    """
+    Gemini APIを使ってAI応答を生成
+
+    Args:
+        user_id: ユーザーID
+        user_message: ユーザーのメッセージ
+        on_first_chunk: ストリーミング中に最初の1文（最大250文字）が
+            揃った時点で呼ばれるコールバック
 
-def generate_ai_response(user_id: str, user_message: str) -> str:
-    """Gemini APIを使ってAI応答を生成"""
+    Returns:
+        AI応答の全文
+    """
     engine = get_db_engine()
     client = get_gemini_client()
 
-    # ユーザープロフィールとタスク情報を取得
+    # ユーザープロフィールと直近の会話履歴（最新20件 = 約10往復分）を1回のクエリで取得
     with engine.connect() as conn:
-        profile_data = conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT up.relationship, up.prefecture, up.municipality, up.death_date
-                FROM user_profiles up
-                WHERE up.user_id = :user_id
-                """
-            ),
-            {"user_id": user_id}
-        ).fetchone()
+        context = conn.execute(SQL_GET_AI_CONTEXT, {"user_id": user_id}).mappings().first()
 
-        # 直近の会話履歴を取得（最新20件 = 約10往復分）
-        conversation_history = conn.execute(
-            sqlalchemy.text(
-                """
-                SELECT role, message
-                FROM conversation_history
-                WHERE user_id = :user_id
-                ORDER BY created_at DESC
-                LIMIT 20
-                """
-            ),
-            {"user_id": user_id}
-        ).fetchall()
+    conversation_history = context["history"] if context else []
+    if isinstance(conversation_history, str):
+        conversation_history = json.loads(conversation_history)
 
     # システムプロンプト作成
-    relationship = profile_data[0] if profile_data else "不明"
-    prefecture = profile_data[1] if profile_data else "不明"
-    municipality = profile_data[2] if profile_data else "不明"
-    death_date = profile_data[3].isoformat() if profile_data and profile_data[3] else "不明"
+    relationship = (context and context["relationship"]) or "不明"
+    prefecture = (context and context["prefecture"]) or "不明"
+    municipality = (context and context["municipality"]) or "不明"
+    death_date = context["death_date"].isoformat() if context and context["death_date"] else "不明"
 
     system_prompt = f"""あなたは「受け継ぐAI」という死後手続きサポートアシスタントです。
 
@@ -1710,829 +2032,350 @@ def generate_ai_response(user_id: str, user_message: str) -> str:
 
 【あなたの応答】"""
 
+    # Geminiで応答生成（ストリーミング）
+    ai_reply = ""
+    first_chunk_sent = on_first_chunk is None
     try:
-        # Gemini 2.5 Proで応答生成
-        response = client.models.generate_content(
-            model='gemini-2.5-pro',
+        for chunk in client.models.generate_content_stream(
+            model=select_ai_model(user_message, knowledge),
             contents=prompt
-        )
-        ai_reply = response.text
+        ):
+            if chunk.text:
+                ai_reply += chunk.text
+
+            if not first_chunk_sent:
+                end = _first_chunk_end(ai_reply)
+                if end:
+                    first_chunk_sent = True
+                    try:
+                        on_first_chunk(ai_reply[:end])
+                    except Exception as e:
+                        # 送信エラー（429・無効なユーザー等）は生成エラーとは扱わず、生成を続ける
+                        # （冒頭部分は呼び出し元が全文と合わせて送信する）
+                        logger.error("LINE push error (first chunk): %s", e)
 
-        # アシスタントの応答を会話履歴に保存
-        with engine.connect() as conn:
-            conn.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO conversation_history (user_id, role, message)
-                    VALUES (:user_id, 'assistant', :message)
-                    """
-                ),
-                {
-                    "user_id": user_id,
-                    "message": ai_reply
-                }
-            )
-            conn.commit()
+    except Exception as e:
+        logger.error("Gemini API error: %s", e)
+        if not ai_reply:
+            return "申し訳ございません。現在システムの調子が悪いようです。しばらく経ってから再度お試しください。"
+        # 途中まで生成できた応答は破棄せず、保存して返す
+        logger.warning("Gemini stream interrupted: returning partial reply (%d chars)", len(ai_reply))
 
-        return ai_reply
+    # アシスタントの応答を会話履歴に保存（呼び出し元の送信を待たせないようバックグラウンドで実行）
+    submit_background(save_assistant_message, user_id, ai_reply)
 
-    except Exception as e:
-        print(f"Gemini API error: {str(e)}")
-        return "申し訳ございません。現在システムの調子が悪いようです。しばらく経ってから再度お試しください。"
+    return ai_reply
 
 
-def handle_postback(event: PostbackEvent):
-    """ポストバックイベント処理"""
-    line_user_id = event.source.user_id
-    postback_data = event.postback.data
-    configuration = get_configuration()
+def _postback_view_task_detail(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """タスク詳細を表示"""
     engine = get_db_engine()
 
-    # line_user_idからuser_idを取得（認証）
+    task_id = params.get('task_id', '')
+
+    # タスク情報と未完了タスク内での順番（無料プランの制限チェックに使用、未完了でなければ-1）を
+    # まとめて取得（user_id検証付き、ユーザーは冒頭で解決済み）
     with engine.connect() as conn:
-        user_result = conn.execute(
-            sqlalchemy.text("SELECT id FROM users WHERE line_user_id = :line_user_id"),
-            {"line_user_id": line_user_id}
+        task_data = conn.execute(
+            SQL_GET_TASK_DETAIL,
+            {"task_id": task_id, "user_id": user_id}
         ).fetchone()
 
-        if not user_result:
-            # ユーザーが見つからない場合はエラー
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text="ユーザー情報が見つかりません。")]
-                    )
-                )
-            return
-
-        user_id = user_result[0]
-
-    # ポストバックデータをパース
-    params = dict(param.split('=') for param in postback_data.split('&'))
-    action = params.get('action', '')
-
-    if action == 'view_task_detail':
-        task_id = params.get('task_id', '')
-
-        # ユーザーIDを取得し、タスク情報を検証付きで取得
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id
-                    FROM users u
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
+        if not task_data:
+            reply_message = "タスクが見つかりません。"
+        else:
+            task_index = task_data.task_index
 
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
+            # プラン制御のチェック
+            plan_controller = get_plan_controller()
+            if not plan_controller.can_access_task_details(str(user_id), task_index):
+                reply_message = plan_controller.get_upgrade_message()
             else:
-                user_id = str(user_data[0])
-
-                # タスク情報を取得(user_id検証付き)
-                task_data = conn.execute(
-                    sqlalchemy.text(
-                        """
-                        SELECT id, title, description, due_date, priority, category, metadata, user_id
-                        FROM tasks
-                        WHERE id = :task_id AND user_id = :user_id
-                        """
-                    ),
-                    {"task_id": task_id, "user_id": user_id}
-                ).fetchone()
+                # タスク詳細のFlex Messageを生成（task_index列を除外）
+                reply_message = create_task_detail_flex(task_data[:7])
 
-                if not task_data:
-                    reply_message = "タスクが見つかりません。"
-                else:
-                    # タスクのインデックスを取得（無料プランの制限チェックに使用）
-                    all_tasks = conn.execute(
-                        sqlalchemy.text(
-                            """
-                            SELECT id
-                            FROM tasks
-                            WHERE user_id = :user_id AND is_deleted = false AND status = 'pending'
-                            ORDER BY due_date ASC
-                            """
-                        ),
-                        {"user_id": user_id}
-                    ).fetchall()
-
-                    task_index = next((i for i, t in enumerate(all_tasks) if str(t[0]) == task_id), -1)
-
-                    # プラン制御のチェック
-                    plan_controller = get_plan_controller()
-                    if not plan_controller.can_access_task_details(user_id, task_index):
-                        reply_message = plan_controller.get_upgrade_message()
-                    else:
-                        # タスク詳細のFlex Messageを生成（user_idフィールドを除外）
-                        from flex_messages import create_task_detail_flex
-                        reply_message = create_task_detail_flex(task_data[:7])
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-
-            # Flex Messageかテキストメッセージか判定
-            if isinstance(reply_message, dict):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[FlexMessage(alt_text="タスク詳細", contents=FlexContainer.from_dict(reply_message))]
-                    )
-                )
-            else:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_message)]
-                    )
-                )
+    send_reply(event.reply_token, reply_message, alt_text="タスク詳細")
 
-    elif action == 'complete_task':
-        task_id = params.get('task_id', '')
 
-        # ユーザーIDを取得
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id
-                    FROM users u
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
-
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
-            else:
-                user_id = user_data[0]
-
-                # タスク情報を取得
-                task_data = conn.execute(
-                    sqlalchemy.text(
-                        """
-                        SELECT title
-                        FROM tasks
-                        WHERE id = :task_id AND user_id = :user_id
-                        """
-                    ),
-                    {"task_id": task_id, "user_id": user_id}
-                ).fetchone()
-
-                if not task_data:
-                    reply_message = "タスクが見つかりません。"
-                else:
-                    task_title = task_data[0]
-
-                    # タスクを完了にする
-                    conn.execute(
-                        sqlalchemy.text(
-                            """
-                            UPDATE tasks
-                            SET status = 'completed'
-                            WHERE id = :task_id AND user_id = :user_id
-                            """
-                        ),
-                        {"task_id": task_id, "user_id": user_id}
-                    )
-
-                    # task_progressに記録
-                    conn.execute(
-                        sqlalchemy.text(
-                            """
-                            INSERT INTO task_progress (task_id, status, completed_at)
-                            VALUES (:task_id, 'completed', :completed_at)
-                            """
-                        ),
-                        {
-                            "task_id": task_id,
-                            "completed_at": datetime.now(timezone.utc)
-                        }
-                    )
+def _postback_complete_task(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """タスクを完了にする"""
+    engine = get_db_engine()
 
-                    conn.commit()
+    task_id = params.get('task_id', '')
 
-                    # 更新されたタスク一覧を表示
-                    reply_message = get_task_list_message(user_id)
+    # タスクの状態を更新し、task_progressに記録（ユーザーは冒頭で解決済み、存在確認も同じ文で行う）
+    with engine.connect() as conn:
+        updated = conn.execute(
+            SQL_SET_TASK_STATUS,
+            {
+                "task_id": task_id,
+                "user_id": user_id,
+                "status": "completed",
+                "completed_at": datetime.now(timezone.utc)
+            }
+        ).fetchone()
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
+        if not updated:
+            reply_message = "タスクが見つかりません。"
+        else:
+            conn.commit()
 
-            # Flex Messageかテキストメッセージか判定
-            if isinstance(reply_message, dict):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[FlexMessage(alt_text="タスク完了", contents=FlexContainer.from_dict(reply_message))]
-                    )
-                )
-            else:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_message)]
-                    )
-                )
+            # 更新されたタスク一覧を表示
+            reply_message = get_task_list_message(user_id, conn=conn)
 
-    elif action == 'uncomplete_task':
-        task_id = params.get('task_id', '')
+    send_reply(event.reply_token, reply_message, alt_text="タスク完了")
 
-        # ユーザーIDを取得
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id
-                    FROM users u
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
 
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
-            else:
-                user_id = user_data[0]
+def _postback_uncomplete_task(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """タスクを未完了に戻す"""
+    engine = get_db_engine()
 
-                # タスク情報を取得
-                task_data = conn.execute(
-                    sqlalchemy.text(
-                        """
-                        SELECT title
-                        FROM tasks
-                        WHERE id = :task_id AND user_id = :user_id
-                        """
-                    ),
-                    {"task_id": task_id, "user_id": user_id}
-                ).fetchone()
+    task_id = params.get('task_id', '')
 
-                if not task_data:
-                    reply_message = "タスクが見つかりません。"
-                else:
-                    task_title = task_data[0]
-
-                    # タスクを未完了に戻す
-                    conn.execute(
-                        sqlalchemy.text(
-                            """
-                            UPDATE tasks
-                            SET status = 'pending'
-                            WHERE id = :task_id AND user_id = :user_id
-                            """
-                        ),
-                        {"task_id": task_id, "user_id": user_id}
-                    )
+    # タスクの状態を更新し、task_progressに記録（ユーザーは冒頭で解決済み、存在確認も同じ文で行う）
+    with engine.connect() as conn:
+        updated = conn.execute(
+            SQL_SET_TASK_STATUS,
+            {
+                "task_id": task_id,
+                "user_id": user_id,
+                "status": "pending",
+                "completed_at": None
+            }
+        ).fetchone()
 
-                    # task_progressに記録
-                    conn.execute(
-                        sqlalchemy.text(
-                            """
-                            INSERT INTO task_progress (task_id, status, completed_at)
-                            VALUES (:task_id, 'pending', NULL)
-                            """
-                        ),
-                        {"task_id": task_id}
-                    )
+        if not updated:
+            reply_message = "タスクが見つかりません。"
+        else:
+            conn.commit()
 
-                    conn.commit()
+            # 更新されたタスク一覧を表示
+            reply_message = get_task_list_message(user_id, conn=conn)
 
-                    # 更新されたタスク一覧を表示
-                    reply_message = get_task_list_message(user_id)
+    send_reply(event.reply_token, reply_message, alt_text="タスク一覧")
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
 
-            # Flex Messageかテキストメッセージか判定
-            if isinstance(reply_message, dict):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[FlexMessage(alt_text="タスク一覧", contents=FlexContainer.from_dict(reply_message))]
-                    )
-                )
-            else:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_message)]
-                    )
-                )
-
-    elif action == 'set_death_date':
-        # Datetimepickerから日付を取得
-        selected_date = event.postback.params.get('date')  # YYYY-MM-DD形式
-
-        # ユーザーIDを取得
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id, up.prefecture, up.municipality
-                    FROM users u
-                    LEFT JOIN user_profiles up ON u.id = up.user_id
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
+def _postback_set_death_date(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """初回登録時の死亡日を保存し、タスク生成を開始"""
+    engine = get_db_engine()
 
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
-            else:
-                user_id = user_data[0]
-                prefecture = user_data[1] or "（未設定）"
-                municipality = user_data[2] or "（未設定）"
+    # Datetimepickerから日付を取得
+    selected_date = event.postback.params.get('date')  # YYYY-MM-DD形式
 
-                # 死亡日を保存
-                death_dt = datetime.fromisoformat(selected_date).date()
+    death_dt = date.fromisoformat(selected_date)
 
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        UPDATE user_profiles
-                        SET death_date = :death_date
-                        WHERE user_id = :user_id
-                        """
-                    ),
-                    {"user_id": user_id, "death_date": death_dt}
-                )
-                conn.commit()
+    # 死亡日を保存し、返信に必要なプロフィール情報を同時に取得
+    with engine.connect() as conn:
+        user_data = conn.execute(
+            SQL_UPDATE_DEATH_DATE,
+            {"user_id": user_id, "death_date": death_dt}
+        ).fetchone()
+        conn.commit()
 
-                # タスク生成をCloud Tasksに投入（非同期）
-                enqueue_task_generation(user_id, line_user_id)
+        if not user_data:
+            reply_message = "ユーザー情報が見つかりません。"
+        else:
+            prefecture = user_data[1] or "（未設定）"
+            municipality = user_data[2] or "（未設定）"
 
-                reply_message = f"""✅ 死亡日を登録しました
+            reply_message = f"""✅ 死亡日を登録しました
 
 🤖 AIがあなた専用のタスクを生成中です...
 
 📍 {prefecture}{municipality}での手続き情報
-📅 死亡日: {death_dt.strftime('%Y年%m月%d日')}
+📅 死亡日: {format_date_ja(death_dt)}
 
 ⏱️ 生成には5分程度かかります。完了したら通知でお知らせします。
 
 しばらくお待ちください。"""
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+    send_reply(event.reply_token, reply_message)
 
-    elif action == 'edit_relationship':
-        # 故人との関係を変更
-        quick_reply = QuickReply(
-            items=[
-                QuickReplyItem(action=MessageAction(label="配偶者", text="配偶者")),
-                QuickReplyItem(action=MessageAction(label="子", text="子")),
-                QuickReplyItem(action=MessageAction(label="親", text="親")),
-                QuickReplyItem(action=MessageAction(label="兄弟姉妹", text="兄弟姉妹")),
-                QuickReplyItem(action=MessageAction(label="孫", text="孫")),
-                QuickReplyItem(action=MessageAction(label="その他", text="その他"))
-            ]
-        )
+    # 返信送信後にタスク生成をCloud Tasksに投入（非同期）
+    if user_data:
+        submit_background(enqueue_task_generation, user_id, line_user_id)
 
-        with engine.connect() as conn:
-            # editing_fieldフラグを設定
-            conn.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO conversation_history (user_id, role, message)
-                    VALUES (
-                        (SELECT id FROM users WHERE line_user_id = :line_user_id),
-                        'system',
-                        'editing:relationship'
-                    )
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            )
-            conn.commit()
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(
-                        text="故人との関係を選択してください",
-                        quick_reply=quick_reply
-                    )]
-                )
-            )
+def _postback_edit_relationship(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """故人との関係を変更"""
+    engine = get_db_engine()
 
-    elif action == 'edit_address':
-        # お住まいを変更（都道府県選択）
-        quick_reply = QuickReply(
-            items=[
-                QuickReplyItem(action=MessageAction(label="東京都", text="東京都")),
-                QuickReplyItem(action=MessageAction(label="神奈川県", text="神奈川県")),
-                QuickReplyItem(action=MessageAction(label="大阪府", text="大阪府")),
-                QuickReplyItem(action=MessageAction(label="愛知県", text="愛知県")),
-                QuickReplyItem(action=MessageAction(label="埼玉県", text="埼玉県")),
-                QuickReplyItem(action=MessageAction(label="千葉県", text="千葉県")),
-                QuickReplyItem(action=MessageAction(label="兵庫県", text="兵庫県")),
-                QuickReplyItem(action=MessageAction(label="福岡県", text="福岡県")),
-                QuickReplyItem(action=MessageAction(label="北海道", text="北海道")),
-                QuickReplyItem(action=MessageAction(label="京都府", text="京都府")),
-                QuickReplyItem(action=MessageAction(label="その他", text="その他"))
-            ]
+    with engine.begin() as conn:
+        # editing_fieldフラグを設定
+        conn.execute(
+            SQL_SET_FLOW_STATE,
+            {"user_id": user_id, "data": "editing:relationship"}
         )
 
-        with engine.connect() as conn:
-            # editing_fieldフラグを設定（都道府県選択中）
-            conn.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO conversation_history (user_id, role, message)
-                    VALUES (
-                        (SELECT id FROM users WHERE line_user_id = :line_user_id),
-                        'system',
-                        'editing:prefecture'
-                    )
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            )
-            conn.commit()
+    send_reply(
+        event.reply_token,
+        "故人との関係を選択してください",
+        quick_reply=EDIT_RELATIONSHIP_QUICK_REPLY
+    )
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(
-                        text="お住まいの都道府県を選択してください",
-                        quick_reply=quick_reply
-                    )]
-                )
-            )
 
-    elif action == 'edit_death_date':
-        # 死亡日を変更
-        with engine.connect() as conn:
-            # editing_fieldフラグを設定
-            conn.execute(
-                sqlalchemy.text(
-                    """
-                    INSERT INTO conversation_history (user_id, role, message)
-                    VALUES (
-                        (SELECT id FROM users WHERE line_user_id = :line_user_id),
-                        'system',
-                        'editing:death_date'
-                    )
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            )
-            conn.commit()
+def _postback_edit_address(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """お住まいを変更（都道府県選択）"""
+    engine = get_db_engine()
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(
-                        text="死亡日を選択してください。\n\n下のボタンからカレンダーが開きます。",
-                        quick_reply=QuickReply(
-                            items=[
-                                QuickReplyItem(
-                                    action=DatetimePickerAction(
-                                        label="📅 日付を選択",
-                                        data="action=update_death_date",
-                                        mode="date"
-                                    )
-                                )
-                            ]
-                        )
-                    )]
-                )
-            )
+    with engine.begin() as conn:
+        # editing_fieldフラグを設定（都道府県選択中）
+        conn.execute(
+            SQL_SET_FLOW_STATE,
+            {"user_id": user_id, "data": "editing:prefecture"}
+        )
 
-    elif action == 'update_death_date':
-        # Datetimepickerで選択された死亡日を更新
-        selected_date = event.postback.params.get('date')  # YYYY-MM-DD形式
+    send_reply(
+        event.reply_token,
+        "お住まいの都道府県を選択してください",
+        quick_reply=PREFECTURE_QUICK_REPLY
+    )
 
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id
-                    FROM users u
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
 
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
-            else:
-                user_id = user_data[0]
+def _postback_edit_death_date(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """死亡日を変更"""
+    engine = get_db_engine()
 
-                # 死亡日を更新
-                from datetime import datetime as dt
-                death_dt = dt.fromisoformat(selected_date)
+    with engine.begin() as conn:
+        # editing_fieldフラグを設定
+        conn.execute(
+            SQL_SET_FLOW_STATE,
+            {"user_id": user_id, "data": "editing:death_date"}
+        )
 
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        UPDATE user_profiles
-                        SET death_date = :death_date
-                        WHERE user_id = :user_id
-                        """
-                    ),
-                    {"user_id": user_id, "death_date": death_dt}
-                )
-                conn.commit()
+    send_reply(
+        event.reply_token,
+        "死亡日を選択してください。\n\n下のボタンからカレンダーが開きます。",
+        quick_reply=UPDATE_DEATH_DATE_QUICK_REPLY
+    )
 
-                # タスク再生成確認
-                reply_message = {
-                    "type": "bubble",
-                    "body": {
-                        "type": "box",
-                        "layout": "vertical",
-                        "contents": [
-                            {
-                                "type": "text",
-                                "text": f"✅ 死亡日を{death_dt.strftime('%Y年%m月%d日')}に変更しました",
-                                "wrap": True,
-                                "weight": "bold",
-                                "color": "#17C964"
-                            },
-                            {
-                                "type": "text",
-                                "text": "タスクの期限を再計算しますか？",
-                                "wrap": True,
-                                "margin": "lg"
-                            }
-                        ]
-                    },
-                    "footer": {
-                        "type": "box",
-                        "layout": "vertical",
-                        "contents": [
-                            {
-                                "type": "button",
-                                "action": {
-                                    "type": "postback",
-                                    "label": "タスクを再生成",
-                                    "data": "action=regenerate_tasks",
-                                    "displayText": "タスクを再生成"
-                                },
-                                "style": "primary",
-                                "color": "#17C964"
-                            },
-                            {
-                                "type": "button",
-                                "action": {
-                                    "type": "message",
-                                    "label": "このまま",
-                                    "text": "設定"
-                                },
-                                "style": "link",
-                                "margin": "sm"
-                            }
-                        ]
-                    }
-                }
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            if isinstance(reply_message, dict):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[FlexMessage(alt_text="死亡日変更完了", contents=FlexContainer.from_dict(reply_message))]
-                    )
-                )
-            else:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_message)]
-                    )
-                )
+def _postback_update_death_date(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """Datetimepickerで選択された死亡日を更新"""
+    engine = get_db_engine()
 
-    elif action == 'add_task_due_date':
-        # Datetimepickerで選択された期限でタスクを追加
-        selected_date = event.postback.params.get('date')  # YYYY-MM-DD形式
+    selected_date = event.postback.params.get('date')  # YYYY-MM-DD形式
 
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id
-                    FROM users u
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
+    death_dt = date.fromisoformat(selected_date)
 
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
-            else:
-                user_id = user_data[0]
+    # 死亡日を更新
+    with engine.connect() as conn:
+        user_data = conn.execute(
+            SQL_UPDATE_DEATH_DATE,
+            {"user_id": user_id, "death_date": death_dt}
+        ).fetchone()
+        conn.commit()
 
-                # タイトルを取得
-                last_system_message = conn.execute(
-                    sqlalchemy.text(
-                        """
-                        SELECT message
-                        FROM conversation_history
-                        WHERE user_id = :user_id AND role = 'system' AND message LIKE 'adding_task:due_date:%'
-                        ORDER BY created_at DESC
-                        LIMIT 1
-                        """
-                    ),
-                    {"user_id": user_id}
-                ).fetchone()
-
-                if last_system_message:
-                    parts = last_system_message[0].split(':')
-                    if len(parts) >= 3:
-                        task_title = ':'.join(parts[2:])
-
-                        # フラグをクリア
-                        conn.execute(
-                            sqlalchemy.text(
-                                """
-                                DELETE FROM conversation_history
-                                WHERE user_id = :user_id AND role = 'system' AND message LIKE 'adding_task:%'
-                                """
-                            ),
-                            {"user_id": user_id}
-                        )
-
-                        # タスクを追加
-                        from datetime import datetime as dt
-                        due_dt = dt.fromisoformat(selected_date)
-
-                        max_order = conn.execute(
-                            sqlalchemy.text("SELECT COALESCE(MAX(order_index), 0) FROM tasks WHERE user_id = :user_id"),
-                            {"user_id": user_id}
-                        ).scalar()
-
-                        conn.execute(
-                            sqlalchemy.text(
-                                """
-                                INSERT INTO tasks (user_id, title, description, category, priority, due_date, status, order_index)
-                                VALUES (:user_id, :title, :description, :category, :priority, :due_date, 'pending', :order_index)
-                                """
-                            ),
-                            {
-                                "user_id": user_id,
-                                "title": task_title,
-                                "description": "手動で追加されたタスク",
-                                "category": "その他",
-                                "priority": "medium",
-                                "due_date": due_dt,
-                                "order_index": max_order + 1
-                            }
-                        )
-                        conn.commit()
-
-                        reply_message = f"✅ タスク「{task_title}」を追加しました\n期限: {due_dt.strftime('%Y年%m月%d日')}"
-                    else:
-                        reply_message = "エラーが発生しました。もう一度お試しください。"
-                else:
-                    reply_message = "エラーが発生しました。もう一度お試しください。"
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
+        if not user_data:
+            reply_message = "ユーザー情報が見つかりません。"
+        else:
+            # タスク再生成確認
+            reply_message = _regenerate_tasks_confirm(
+                f"✅ 死亡日を{format_date_ja(death_dt)}に変更しました",
+                _DEATH_DATE_CHANGED_NOTICE
             )
 
-    elif action == 'edit_memo':
-        # メモ編集モードに入る
-        task_id = event.postback.data.split('task_id=')[1]
+    send_reply(event.reply_token, reply_message, alt_text="死亡日変更完了")
 
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id
-                    FROM users u
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
 
-            if user_data:
-                user_id = user_data[0]
+def _postback_add_task_due_date(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """Datetimepickerで選択された期限でタスクを追加"""
+    engine = get_db_engine()
+
+    selected_date = event.postback.params.get('date')  # YYYY-MM-DD形式
 
-                # editing_memoフラグを設定
+    with engine.connect() as conn:
+        # タイトルを取得
+        last_system_message = conn.execute(
+            SQL_GET_FLOW_STATE_LIKE,
+            {"user_id": user_id, "pattern": "adding_task:due_date:%"}
+        ).fetchone()
+
+        if last_system_message:
+            parts = last_system_message[0].split(':')
+            if len(parts) >= 3:
+                task_title = ':'.join(parts[2:])
+
+                # フラグをクリア
                 conn.execute(
-                    sqlalchemy.text(
-                        """
-                        INSERT INTO conversation_history (user_id, role, message)
-                        VALUES (:user_id, 'system', :data)
-                        """
-                    ),
-                    {"user_id": user_id, "data": f"editing_memo:{task_id}"}
+                    SQL_CLEAR_FLOW_STATE,
+                    {"user_id": user_id, "pattern": "adding_task:%"}
                 )
+
+                # タスクを追加
+                due_dt = date.fromisoformat(selected_date)
+
+                insert_manual_task(conn, user_id, task_title, due_dt)
                 conn.commit()
 
-                reply_message = "メモを入力してください。\n\nメモを削除する場合は「削除」と送信してください。"
+                reply_message = f"✅ タスク「{task_title}」を追加しました\n期限: {format_date_ja(due_dt)}"
             else:
-                reply_message = "ユーザー情報が見つかりません。"
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+                reply_message = "エラーが発生しました。もう一度お試しください。"
+        else:
+            reply_message = "エラーが発生しました。もう一度お試しください。"
 
-    elif action == 'regenerate_tasks':
-        # 既存タスクを削除してタスクを再生成
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT u.id
-                    FROM users u
-                    WHERE u.line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
+    send_reply(event.reply_token, reply_message)
 
-            if user_data:
-                user_id = user_data[0]
 
-                # 既存タスクを削除
-                conn.execute(
-                    sqlalchemy.text("DELETE FROM tasks WHERE user_id = :user_id"),
-                    {"user_id": user_id}
-                )
-                conn.commit()
+def _postback_edit_memo(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """メモ編集モードに入る"""
+    engine = get_db_engine()
+
+    task_id = event.postback.data.split('task_id=')[1]
+
+    with engine.begin() as conn:
+        # editing_memoフラグを設定
+        conn.execute(
+            SQL_SET_FLOW_STATE,
+            {"user_id": user_id, "data": f"editing_memo:{task_id}"}
+        )
+
+        reply_message = "メモを入力してください。\n\nメモを削除する場合は「削除」と送信してください。"
+
+    send_reply(event.reply_token, reply_message)
 
-                # タスク再生成をCloud Tasksに投入
-                enqueue_task_generation(user_id, line_user_id)
 
-                reply_message = """✅ タスクを再生成しています
+def _postback_regenerate_tasks(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """既存タスクを削除してタスクを再生成"""
+    engine = get_db_engine()
+
+    with engine.begin() as conn:
+        # 既存タスクを削除
+        conn.execute(
+            SQL_DELETE_USER_TASKS,
+            {"user_id": user_id}
+        )
+
+        reply_message = """✅ タスクを再生成しています
 
 🤖 AIがあなた専用のタスクを生成中です...
 
 ⏱️ 生成には5分程度かかります。完了したら通知でお知らせします。"""
-            else:
-                reply_message = "ユーザー情報が見つかりません。"
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
 
-    elif action == 'view_subscription_status':
-        # サブスクリプションステータスの確認（Issue #19対応）
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT id, subscription_status, subscription_plan, subscription_start_date, subscription_end_date
-                    FROM users
-                    WHERE line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
+    send_reply(event.reply_token, reply_message)
 
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
-            else:
-                user_id, status, plan, start_date, end_date = user_data
+    # 返信送信後にタスク再生成をCloud Tasksに投入
+    submit_background(enqueue_task_generation, user_id, line_user_id)
+
+
+def _postback_view_subscription_status(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """サブスクリプションステータスの確認（Issue #19対応）"""
+    subscription = get_subscription(line_user_id)
+
+    if not subscription:
+        reply_message = "ユーザー情報が見つかりません。"
+    else:
+        _, status, plan, start_date, end_date = subscription
 
-                # サブスクリプションステータスに応じたメッセージを生成
-                if status == 'active':
-                    status_emoji = "✅"
-                    status_text = "有効"
-                    plan_text = plan or "スタンダードプラン"
-                    start_text = start_date.strftime("%Y年%m月%d日") if start_date else "不明"
-                    end_text = end_date.strftime("%Y年%m月%d日") if end_date else "継続中"
+        # サブスクリプションステータスに応じたメッセージを生成
+        if status == 'active':
+            status_emoji = "✅"
+            status_text = "有効"
+            plan_text = plan or "スタンダードプラン"
+            start_text = format_date_ja(start_date) if start_date else "不明"
+            end_text = format_date_ja(end_date) if end_date else "継続中"
 
-                    reply_message = f"""{status_emoji} サブスクリプションステータス
+            reply_message = f"""{status_emoji} サブスクリプションステータス
 
 【現在の状態】
 ステータス: {status_text}
@@ -2542,12 +2385,12 @@ def handle_postback(event: PostbackEvent):
 
 サブスクリプションは正常に継続されています。"""
 
-                elif status == 'cancelled':
-                    status_emoji = "⚠️"
-                    status_text = "解約済み"
-                    end_text = end_date.strftime("%Y年%m月%d日") if end_date else "不明"
+        elif status == 'cancelled':
+            status_emoji = "⚠️"
+            status_text = "解約済み"
+            end_text = format_date_ja(end_date) if end_date else "不明"
 
-                    reply_message = f"""{status_emoji} サブスクリプションステータス
+            reply_message = f"""{status_emoji} サブスクリプションステータス
 
 【現在の状態】
 ステータス: {status_text}
@@ -2556,187 +2399,165 @@ def handle_postback(event: PostbackEvent):
 サブスクリプションは解約されています。
 期限まではサービスをご利用いただけます。"""
 
-                else:
-                    # 未契約またはその他の状態
-                    reply_message = """💡 サブスクリプション未契約
+        else:
+            # 未契約またはその他の状態
+            reply_message = """💡 サブスクリプション未契約
 
 現在サブスクリプションに未登録です。
 プレミアム機能をご利用いただくには、サブスクリプションへの登録が必要です。
 
 詳細はウェブサイトをご確認ください。"""
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+    send_reply(event.reply_token, reply_message)
 
-    elif action == 'cancel_subscription':
-        # サブスクリプション解約（Issue #19対応）
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT id, subscription_status
-                    FROM users
-                    WHERE line_user_id = :line_user_id
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
 
-            if not user_data:
-                reply_message = "ユーザー情報が見つかりません。"
-            else:
-                user_id, status = user_data
-
-                if status == 'active':
-                    # 解約確認メッセージを送信
-                    reply_message = {
-                        "type": "bubble",
-                        "body": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "text",
-                                    "text": "⚠️ サブスクリプション解約",
-                                    "weight": "bold",
-                                    "size": "lg",
-                                    "color": "#FF6B6B"
-                                },
-                                {
-                                    "type": "text",
-                                    "text": "本当に解約しますか？",
-                                    "wrap": True,
-                                    "margin": "md"
-                                },
-                                {
-                                    "type": "text",
-                                    "text": "• 現在の契約期間終了後、サービスが利用できなくなります\n• タスク生成などの機能が制限されます",
-                                    "wrap": True,
-                                    "size": "sm",
-                                    "color": "#999999",
-                                    "margin": "md"
-                                }
-                            ]
-                        },
-                        "footer": {
-                            "type": "box",
-                            "layout": "vertical",
-                            "contents": [
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "postback",
-                                        "label": "解約を確定する",
-                                        "data": "action=confirm_cancel_subscription",
-                                        "displayText": "解約を確定"
-                                    },
-                                    "style": "primary",
-                                    "color": "#FF6B6B"
-                                },
-                                {
-                                    "type": "button",
-                                    "action": {
-                                        "type": "message",
-                                        "label": "キャンセル",
-                                        "text": "設定"
-                                    },
-                                    "style": "link",
-                                    "margin": "sm"
-                                }
-                            ]
-                        }
-                    }
-                else:
-                    reply_message = "現在有効なサブスクリプションがありません。"
-
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            if isinstance(reply_message, dict):
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[
-                            FlexMessage(
-                                alt_text="サブスクリプション解約確認",
-                                contents=FlexContainer.from_dict(reply_message)
-                            )
-                        ]
-                    )
-                )
-            else:
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_message)]
-                    )
-                )
+# 解約確認のFlex Message（内容が固定のためモジュールロード時に一度だけFlexContainerまで構築して共有する）
+_CANCEL_SUBSCRIPTION_CONFIRM = FlexContainer.from_dict({
+    "type": "bubble",
+    "body": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "text",
+                "text": "⚠️ サブスクリプション解約",
+                "weight": "bold",
+                "size": "lg",
+                "color": "#FF6B6B"
+            },
+            {
+                "type": "text",
+                "text": "本当に解約しますか？",
+                "wrap": True,
+                "margin": "md"
+            },
+            {
+                "type": "text",
+                "text": "• 現在の契約期間終了後、サービスが利用できなくなります\n• タスク生成などの機能が制限されます",
+                "wrap": True,
+                "size": "sm",
+                "color": "#999999",
+                "margin": "md"
+            }
+        ]
+    },
+    "footer": {
+        "type": "box",
+        "layout": "vertical",
+        "contents": [
+            {
+                "type": "button",
+                "action": {
+                    "type": "postback",
+                    "label": "解約を確定する",
+                    "data": "action=confirm_cancel_subscription",
+                    "displayText": "解約を確定"
+                },
+                "style": "primary",
+                "color": "#FF6B6B"
+            },
+            {
+                "type": "button",
+                "action": {
+                    "type": "message",
+                    "label": "キャンセル",
+                    "text": "設定"
+                },
+                "style": "link",
+                "margin": "sm"
+            }
+        ]
+    }
+})
 
-    elif action == 'confirm_cancel_subscription':
-        # サブスクリプション解約確定（Issue #19対応）
-        with engine.connect() as conn:
-            user_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT id, subscription_end_date
-                    FROM users
-                    WHERE line_user_id = :line_user_id AND subscription_status = 'active'
-                    """
-                ),
-                {"line_user_id": line_user_id}
-            ).fetchone()
 
-            if not user_data:
-                reply_message = "有効なサブスクリプションが見つかりません。"
-            else:
-                user_id, end_date = user_data
+def _postback_cancel_subscription(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """サブスクリプション解約（Issue #19対応）"""
+    subscription = get_subscription(line_user_id)
 
-                # サブスクリプションステータスを解約に変更
-                conn.execute(
-                    sqlalchemy.text(
-                        """
-                        UPDATE users
-                        SET subscription_status = 'cancelled'
-                        WHERE id = :user_id
-                        """
-                    ),
-                    {"user_id": user_id}
-                )
-                conn.commit()
+    if not subscription:
+        reply_message = "ユーザー情報が見つかりません。"
+    else:
+        status = subscription[1]
+
+        if status == 'active':
+            # 解約確認メッセージを送信
+            reply_message = _CANCEL_SUBSCRIPTION_CONFIRM
+        else:
+            reply_message = "現在有効なサブスクリプションがありません。"
+
+    send_reply(event.reply_token, reply_message, alt_text="サブスクリプション解約確認")
 
-                end_text = end_date.strftime("%Y年%m月%d日") if end_date else "契約期間終了時"
 
-                reply_message = f"""✅ サブスクリプションを解約しました
+def _postback_confirm_cancel_subscription(event: PostbackEvent, user_id, line_user_id: str, params: dict):
+    """サブスクリプション解約確定（Issue #19対応）"""
+    engine = get_db_engine()
+
+    # サブスクリプションステータスを解約に変更（有効なサブスクリプションがなければ更新されない）
+    with engine.begin() as conn:
+        cancelled = conn.execute(
+            SQL_CANCEL_SUBSCRIPTION,
+            {"line_user_id": line_user_id}
+        ).fetchone()
+
+    if not cancelled:
+        reply_message = "有効なサブスクリプションが見つかりません。"
+    else:
+        end_date = cancelled[1]
+        end_text = format_date_ja(end_date) if end_date else "契約期間終了時"
+
+        reply_message = f"""✅ サブスクリプションを解約しました
 
 {end_text}までサービスをご利用いただけます。
 
 ご利用ありがとうございました。
 またのご利用をお待ちしております。"""
 
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_message)]
-                )
-            )
+    send_reply(event.reply_token, reply_message)
 
-    else:
+
+# ポストバックのactionごとの処理（actionの追加時はここに登録する）
+POSTBACK_ACTIONS = {
+    'view_task_detail': _postback_view_task_detail,
+    'complete_task': _postback_complete_task,
+    'uncomplete_task': _postback_uncomplete_task,
+    'set_death_date': _postback_set_death_date,
+    'edit_relationship': _postback_edit_relationship,
+    'edit_address': _postback_edit_address,
+    'edit_death_date': _postback_edit_death_date,
+    'update_death_date': _postback_update_death_date,
+    'add_task_due_date': _postback_add_task_due_date,
+    'edit_memo': _postback_edit_memo,
+    'regenerate_tasks': _postback_regenerate_tasks,
+    'view_subscription_status': _postback_view_subscription_status,
+    'cancel_subscription': _postback_cancel_subscription,
+    'confirm_cancel_subscription': _postback_confirm_cancel_subscription,
+}
+
+
+def handle_postback(event: PostbackEvent):
+    """ポストバックイベント処理"""
+    line_user_id = event.source.user_id
+    postback_data = event.postback.data
+
+    # line_user_idからuser_idを取得（認証）
+    user_id = resolve_user_id(line_user_id)
+    if user_id is None:
+        # ユーザーが見つからない場合はエラー
+        send_reply(event.reply_token, "ユーザー情報が見つかりません。")
+        return
+
+    # ポストバックデータをパース
+    params = dict(parse_qsl(postback_data, keep_blank_values=True))
+    action = params.get('action', '')
+
+    handler = POSTBACK_ACTIONS.get(action)
+    if handler is None:
         # 未知のアクション
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=f"不明なアクション: {action}")]
-                )
-            )
+        send_reply(event.reply_token, f"不明なアクション: {action}")
+        return
+
+    handler(event, user_id, line_user_id, params)
 
 
 @functions_framework.http
@@ -2760,31 +2581,24 @@ def personalized_tasks_worker(request: Request):
 
         engine = get_db_engine()
 
-        # ユーザー所有権検証
+        # 所有権検証からStep 2完了のマークまで同じ接続を使う（プールからの取得は1回）
         with engine.connect() as conn:
+            # ユーザー所有権検証
             try:
                 verify_user_ownership(conn, line_user_id, user_id)
             except AuthorizationError as e:
-                print(f"❌ 認可エラー: {e}")
+                logger.error("❌ 認可エラー: %s", e)
                 return jsonify({"error": "Unauthorized access"}), 403
 
-        print(f"🔄 Step 2: 個別タスク生成開始: user_id={user_id}")
+            logger.info("🔄 Step 2: 個別タスク生成開始: user_id=%s", user_id)
 
-        # Step 2開始をマーク
-        with engine.connect() as conn:
+            # Step 2開始をマーク
             flow_manager = ConversationFlowManager(conn)
             flow_manager.set_task_generation_step_status(user_id, 'personalized', 'in_progress')
 
-        # プロフィールと追加回答を取得
-        with engine.connect() as conn:
+            # プロフィールと追加回答を取得
             profile_data = conn.execute(
-                sqlalchemy.text(
-                    """
-                    SELECT relationship, prefecture, municipality, death_date
-                    FROM user_profiles
-                    WHERE user_id = :user_id
-                    """
-                ),
+                SQL_GET_PROFILE,
                 {"user_id": user_id}
             ).fetchone()
 
@@ -2797,37 +2611,36 @@ def personalized_tasks_worker(request: Request):
 
             additional_answers = get_user_answers(user_id, conn)
 
-        # Step 2: 個別タスク生成
-        with engine.connect() as conn:
+            # Step 2: 個別タスク生成
             personalized_tasks = generate_personalized_tasks(
                 user_id, profile, additional_answers, conn
             )
 
-        print(f"✅ Step 2完了: {len(personalized_tasks)}件の個別タスクを生成")
+            logger.info("✅ Step 2完了: %s件の個別タスクを生成", len(personalized_tasks))
 
-        # Step 2完了をマーク
-        with engine.connect() as conn:
-            flow_manager = ConversationFlowManager(conn)
+            # Step 2完了をマーク
             flow_manager.set_task_generation_step_status(
                 user_id, 'personalized', 'completed',
                 metadata={'task_count': len(personalized_tasks)}
             )
 
+        # Step 3: Tips収集の投入とLINE通知は互いに独立しているため並行して行う
+        # 通知の失敗でこのジョブがリトライされてもTips収集が重複しないよう、
+        # リトライ間で変わらないCloud Tasksのタスク名からタスクIDを決める
+        cloud_task_name = request.headers.get('X-CloudTasks-TaskName')
+        tips_task_id = f"tips-{user_id}-{cloud_task_name}" if cloud_task_name else None
+        submit_background(enqueue_tips_enhancement, user_id, line_user_id, tips_task_id)
+
         # LINE通知
-        configuration = get_configuration()
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=line_user_id,
-                    messages=[TextMessage(
-                        text=f"✅ あなた専用の追加タスクを{len(personalized_tasks)}件生成しました！\n\n「タスク」と送信して確認してください。"
-                    )]
-                )
+        line_bot_api = get_messaging_api()
+        line_bot_api.push_message(
+            PushMessageRequest(
+                to=line_user_id,
+                messages=[TextMessage(
+                    text=f"✅ あなた専用の追加タスクを{len(personalized_tasks)}件生成しました！\n\n「タスク」と送信して確認してください。"
+                )]
             )
-
-        # Step 3: Tips収集をバックグラウンドで開始
-        enqueue_tips_enhancement(user_id, line_user_id)
+        )
 
         return jsonify({
             "status": "success",
@@ -2836,9 +2649,7 @@ def personalized_tasks_worker(request: Request):
         }), 200
 
     except Exception as e:
-        print(f"❌ 個別タスク生成エラー: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ 個別タスク生成エラー: %s", e)
 
         if 'user_id' in locals():
             with engine.connect() as conn:
@@ -2850,6 +2661,10 @@ def personalized_tasks_worker(request: Request):
 
         return jsonify({"error": str(e)}), 500
 
+    finally:
+        # Tips収集ジョブの投入が終わるまでインスタンスを解放しない
+        wait_background_tasks()
+
 
 @functions_framework.http
 def tips_enhancement_worker(request: Request):
@@ -2872,27 +2687,24 @@ def tips_enhancement_worker(request: Request):
 
         engine = get_db_engine()
 
-        # ユーザー所有権検証
+        # 所有権検証からStep 3完了のマークまで同じ接続を使う（プールからの取得は1回）
         with engine.connect() as conn:
+            # ユーザー所有権検証
             try:
                 verify_user_ownership(conn, line_user_id, user_id)
             except AuthorizationError as e:
-                print(f"❌ 認可エラー: {e}")
+                logger.error("❌ 認可エラー: %s", e)
                 return jsonify({"error": "Unauthorized access"}), 403
 
-        print(f"🔄 Step 3: Tips収集開始: user_id={user_id}")
+            logger.info("🔄 Step 3: Tips収集開始: user_id=%s", user_id)
 
-        # Step 3開始をマーク
-        with engine.connect() as conn:
+            # Step 3開始をマーク
             flow_manager = ConversationFlowManager(conn)
             flow_manager.set_task_generation_step_status(user_id, 'enhanced', 'in_progress')
 
-        # プロフィール取得
-        with engine.connect() as conn:
+            # プロフィール取得
             profile_data = conn.execute(
-                sqlalchemy.text(
-                    "SELECT relationship, prefecture, municipality, death_date FROM user_profiles WHERE user_id = :user_id"
-                ),
+                SQL_GET_PROFILE,
                 {"user_id": user_id}
             ).fetchone()
 
@@ -2903,33 +2715,28 @@ def tips_enhancement_worker(request: Request):
                 'death_date': profile_data[3]
             }
 
-        # Step 3: Tips収集・拡張
-        with engine.connect() as conn:
+            # Step 3: Tips収集・拡張
             stats = enhance_tasks_with_tips(user_id, conn)
             generate_general_tips_task(user_id, profile, conn)
 
-        print(f"✅ Step 3完了: {stats['enhanced_count']}件のタスクに{stats['new_tips_count']}個のTipsを追加")
+            logger.info("✅ Step 3完了: %s件のタスクに%s個のTipsを追加", stats['enhanced_count'], stats['new_tips_count'])
 
-        # Step 3完了をマーク
-        with engine.connect() as conn:
-            flow_manager = ConversationFlowManager(conn)
+            # Step 3完了をマーク
             flow_manager.set_task_generation_step_status(
                 user_id, 'enhanced', 'completed',
                 metadata=stats
             )
 
         # LINE通知
-        configuration = get_configuration()
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=line_user_id,
-                    messages=[TextMessage(
-                        text=f"💡 タスクに実用的なTipsを追加しました！\n\n体験談や裏技を参考にして、スムーズに手続きを進めてください。"
-                    )]
-                )
+        line_bot_api = get_messaging_api()
+        line_bot_api.push_message(
+            PushMessageRequest(
+                to=line_user_id,
+                messages=[TextMessage(
+                    text=f"💡 タスクに実用的なTipsを追加しました！\n\n体験談や裏技を参考にして、スムーズに手続きを進めてください。"
+                )]
             )
+        )
 
         return jsonify({
             "status": "success",
@@ -2939,9 +2746,7 @@ def tips_enhancement_worker(request: Request):
         }), 200
 
     except Exception as e:
-        print(f"❌ Tips収集エラー: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Tips収集エラー: %s", e)
 
         if 'user_id' in locals():
             with engine.connect() as conn:
@@ -2970,7 +2775,7 @@ def stripe_webhook(request: Request):
         sig_header = request.headers.get('Stripe-Signature')
 
         if not sig_header:
-            print("❌ Stripe署名ヘッダーがありません")
+            logger.error("❌ Stripe署名ヘッダーがありません")
             return jsonify({"error": "No signature header"}), 400
 
         # Stripe署名を検証してイベントを構築
@@ -2980,12 +2785,12 @@ def stripe_webhook(request: Request):
                 payload, sig_header, webhook_secret
             )
         except stripe.error.SignatureVerificationError as e:
-            print(f"❌ Stripe署名検証エラー: {str(e)}")
+            logger.error("❌ Stripe署名検証エラー: %s", e)
             return jsonify({"error": "Invalid signature"}), 400
 
         # イベントタイプに応じて処理
         event_type = event['type']
-        print(f"📬 Stripe Webhookイベント受信: {event_type}")
+        logger.info("📬 Stripe Webhookイベント受信: %s", event_type)
 
         subscription_manager = get_subscription_manager()
 
@@ -2993,37 +2798,33 @@ def stripe_webhook(request: Request):
             # 決済完了イベント
             session = event['data']['object']
             subscription_manager.handle_checkout_completed(session)
-            print(f"✅ Checkout完了処理: user_id={session['metadata'].get('user_id')}")
+            logger.info("✅ Checkout完了処理: user_id=%s", session['metadata'].get('user_id'))
 
         elif event_type == 'customer.subscription.deleted':
             # サブスクリプションキャンセルイベント
             subscription = event['data']['object']
             subscription_manager.handle_subscription_deleted(subscription)
-            print(f"✅ サブスクリプション削除処理: subscription_id={subscription['id']}")
+            logger.info("✅ サブスクリプション削除処理: subscription_id=%s", subscription['id'])
 
         else:
             # その他のイベントはログのみ
-            print(f"ℹ️ 未処理のイベントタイプ: {event_type}")
+            logger.info("ℹ️ 未処理のイベントタイプ: %s", event_type)
 
         return jsonify({"status": "success"}), 200
 
     except Exception as e:
-        print(f"❌ Stripe Webhookエラー: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ Stripe Webhookエラー: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
 def handle_upgrade_request(user_id: str, line_user_id: str):
     """アップグレードリクエストを処理"""
-    engine = get_db_engine()
     subscription_manager = get_subscription_manager()
-    plan_controller = get_plan_controller()
 
-    # 現在のプラン状態を確認
-    if subscription_manager.is_premium_user(str(user_id)):
+    # 現在のプラン状態を確認（判定とサブスクリプション情報を1回の取得で得る）
+    is_premium, subscription = subscription_manager.get_status_bundle(str(user_id))
+    if is_premium:
         # 既に有料プランの場合
-        subscription = subscription_manager.get_user_subscription(str(user_id))
         return f"""✅ 有料プラン加入中です
 
 現在のプラン: β版プラン（月額500円）
@@ -3074,7 +2875,7 @@ def handle_upgrade_request(user_id: str, line_user_id: str):
 ※テスト環境では実際の決済は行われません"""
 
     except Exception as e:
-        print(f"Stripe Checkoutセッション作成エラー: {str(e)}")
+        logger.error("Stripe Checkoutセッション作成エラー: %s", e)
         return """申し訳ございません。現在アップグレード処理に問題が発生しています。
 
 しばらく経ってから再度お試しください。
@@ -3115,16 +2916,10 @@ ko_15_ko_15-m1@yahoo.co.jp
 - 質問は自由に入力してください"""
 
 
-def get_plan_info_section(user_id: str):
+def _build_plan_info_section(is_premium: bool) -> dict:
     """プラン情報セクションを生成"""
-    subscription_manager = get_subscription_manager()
-    plan_controller = get_plan_controller()
-
-    is_premium = subscription_manager.is_premium_user(str(user_id))
-
     if is_premium:
         # 有料プランの場合
-        subscription = subscription_manager.get_user_subscription(str(user_id))
         plan_text = "β版プラン（月額500円）"
         status_text = "✅ アクティブ"
         button_label = "プラン管理"
@@ -3183,205 +2978,319 @@ def get_plan_info_section(user_id: str):
     }
 
 
-def get_settings_message(user_id: str, relationship: str, prefecture: str, municipality: str, death_date):
-    """設定メッセージを生成（FlexMessage形式）"""
-    # 死亡日をフォーマット
-    death_date_str = death_date.strftime("%Y年%m月%d日") if death_date else "未設定"
+# プラン情報セクションは有料/無料の2種類のみのため、モジュールロード時に構築して共有する
+_PLAN_INFO_SECTIONS = {
+    True: _build_plan_info_section(True),
+    False: _build_plan_info_section(False)
+}
+
+
+def get_plan_info_section(user_id: str):
+    """プラン情報セクションを取得（Stripe Webhookでの加入・解約を即時に反映するため毎回DBで判定する）"""
+    return _PLAN_INFO_SECTIONS[get_subscription_manager().is_premium_user(str(user_id))]
 
+
+# プロフィール変更後のタスク再生成確認メッセージの静的部分
+# （変更内容のテキストノードのみ呼び出しごとに作成し、他は呼び出し間で共有する）
+_REGENERATE_TASKS_FOOTER = {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+        {
+            "type": "button",
+            "action": {
+                "type": "postback",
+                "label": "タスクを再生成",
+                "data": "action=regenerate_tasks",
+                "displayText": "タスクを再生成"
+            },
+            "style": "primary",
+            "color": "#17C964"
+        },
+        {
+            "type": "button",
+            "action": {
+                "type": "message",
+                "label": "このまま",
+                "text": "設定"
+            },
+            "style": "link",
+            "margin": "sm"
+        }
+    ]
+}
+
+_ADDRESS_CHANGED_NOTICE = {
+    "type": "text",
+    "text": "住所が変わると、窓口情報や手続き内容が変わる可能性があります。タスクを再生成しますか？",
+    "wrap": True,
+    "margin": "lg",
+    "size": "sm"
+}
+
+_DEATH_DATE_CHANGED_NOTICE = {
+    "type": "text",
+    "text": "タスクの期限を再計算しますか？",
+    "wrap": True,
+    "margin": "lg"
+}
+
+
+def _regenerate_tasks_confirm(changed_text: str, notice: dict) -> dict:
+    """プロフィール変更完了とタスク再生成確認のFlex Messageを生成"""
     return {
         "type": "bubble",
-        "header": {
+        "body": {
             "type": "box",
             "layout": "vertical",
             "contents": [
                 {
                     "type": "text",
-                    "text": "⚙️ 設定",
+                    "text": changed_text,
+                    "wrap": True,
                     "weight": "bold",
-                    "size": "lg",
-                    "color": "#333333"
-                }
-            ],
-            "paddingAll": "15px",
-            "backgroundColor": "#F7F7F7"
+                    "color": "#17C964"
+                },
+                notice
+            ]
+        },
+        "footer": _REGENERATE_TASKS_FOOTER
+    }
+
+
+# 設定メッセージの静的部分（モジュールロード時に一度だけ構築し、呼び出し間で共有する）
+# FlexContainer.from_dict は辞書を変更しないため共有しても安全
+_SETTINGS_HEADER = {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+        {
+            "type": "text",
+            "text": "⚙️ 設定",
+            "weight": "bold",
+            "size": "lg",
+            "color": "#333333"
+        }
+    ],
+    "paddingAll": "15px",
+    "backgroundColor": "#F7F7F7"
+}
+
+# 故人との関係
+_RELATIONSHIP_SECTION = {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+        {
+            "type": "text",
+            "text": "👤 故人との関係",
+            "size": "sm",
+            "color": "#999999",
+            "weight": "bold"
+        },
+        {
+            "type": "text",
+            "text": "",
+            "size": "md",
+            "color": "#333333",
+            "wrap": True,
+            "margin": "sm"
+        },
+        {
+            "type": "button",
+            "action": {
+                "type": "postback",
+                "label": "変更",
+                "data": "action=edit_relationship",
+                "displayText": "故人との関係を変更"
+            },
+            "style": "link",
+            "height": "sm",
+            "margin": "sm"
+        }
+    ],
+    "paddingAll": "12px",
+    "backgroundColor": "#FAFAFA",
+    "cornerRadius": "8px"
+}
+
+# お住まい
+_ADDRESS_SECTION = {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+        {
+            "type": "text",
+            "text": "📍 お住まい",
+            "size": "sm",
+            "color": "#999999",
+            "weight": "bold"
+        },
+        {
+            "type": "text",
+            "text": "",
+            "size": "md",
+            "color": "#333333",
+            "wrap": True,
+            "margin": "sm"
+        },
+        {
+            "type": "button",
+            "action": {
+                "type": "postback",
+                "label": "変更",
+                "data": "action=edit_address",
+                "displayText": "お住まいを変更"
+            },
+            "style": "link",
+            "height": "sm",
+            "margin": "sm"
+        }
+    ],
+    "paddingAll": "12px",
+    "backgroundColor": "#FAFAFA",
+    "cornerRadius": "8px",
+    "margin": "md"
+}
+
+# 死亡日
+_DEATH_DATE_SECTION = {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+        {
+            "type": "text",
+            "text": "📅 死亡日",
+            "size": "sm",
+            "color": "#999999",
+            "weight": "bold"
+        },
+        {
+            "type": "text",
+            "text": "",
+            "size": "md",
+            "color": "#333333",
+            "wrap": True,
+            "margin": "sm"
+        },
+        {
+            "type": "button",
+            "action": {
+                "type": "postback",
+                "label": "変更",
+                "data": "action=edit_death_date",
+                "displayText": "死亡日を変更"
+            },
+            "style": "link",
+            "height": "sm",
+            "margin": "sm"
+        }
+    ],
+    "paddingAll": "12px",
+    "backgroundColor": "#FAFAFA",
+    "cornerRadius": "8px",
+    "margin": "md"
+}
+
+# サブスクリプション管理（Issue #19対応）
+_SUBSCRIPTION_SECTION = {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+        {
+            "type": "text",
+            "text": "💳 サブスクリプション",
+            "size": "sm",
+            "color": "#999999",
+            "weight": "bold"
+        },
+        {
+            "type": "button",
+            "action": {
+                "type": "postback",
+                "label": "ステータスを確認",
+                "data": "action=view_subscription_status",
+                "displayText": "サブスクリプションステータスを確認"
+            },
+            "style": "link",
+            "height": "sm",
+            "margin": "sm"
         },
+        {
+            "type": "button",
+            "action": {
+                "type": "postback",
+                "label": "解約手続き",
+                "data": "action=cancel_subscription",
+                "displayText": "サブスクリプションを解約"
+            },
+            "style": "link",
+            "height": "sm",
+            "margin": "sm",
+            "color": "#FF6B6B"
+        }
+    ],
+    "paddingAll": "12px",
+    "backgroundColor": "#FAFAFA",
+    "cornerRadius": "8px",
+    "margin": "md"
+}
+
+# 注意書き
+_SETTINGS_NOTICE = {
+    "type": "box",
+    "layout": "vertical",
+    "contents": [
+        {
+            "type": "text",
+            "text": "💡 死亡日を変更すると、タスクの期限も再計算されます。",
+            "size": "xs",
+            "color": "#999999",
+            "wrap": True
+        }
+    ],
+    "margin": "lg"
+}
+
+
+def _profile_section(template: dict, value: str) -> dict:
+    """プロフィール項目セクションを生成（値のテキストノードのみ新規作成し、他はテンプレートを共有）"""
+    label, value_text, button = template["contents"]
+    return {
+        **template,
+        "contents": [label, {**value_text, "text": value}, button]
+    }
+
+
+@lru_cache(maxsize=512)
+def _death_date_section(death_date_str: str) -> dict:
+    """
+    死亡日セクションを生成
+
+    日付文字列ごとにキャッシュするため、戻り値は変更しないこと
+    """
+    return _profile_section(_DEATH_DATE_SECTION, death_date_str)
+
+
+def get_settings_message(user_id: str, relationship: str, prefecture: str, municipality: str, death_date):
+    """設定メッセージを生成（FlexMessage形式）"""
+    # 死亡日をフォーマット
+    death_date_str = format_date_ja(death_date) if death_date else "未設定"
+
+    return {
+        "type": "bubble",
+        "header": _SETTINGS_HEADER,
         "body": {
             "type": "box",
             "layout": "vertical",
             "contents": [
-                # 故人との関係
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "👤 故人との関係",
-                            "size": "sm",
-                            "color": "#999999",
-                            "weight": "bold"
-                        },
-                        {
-                            "type": "text",
-                            "text": relationship or "未設定",
-                            "size": "md",
-                            "color": "#333333",
-                            "wrap": True,
-                            "margin": "sm"
-                        },
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "postback",
-                                "label": "変更",
-                                "data": "action=edit_relationship",
-                                "displayText": "故人との関係を変更"
-                            },
-                            "style": "link",
-                            "height": "sm",
-                            "margin": "sm"
-                        }
-                    ],
-                    "paddingAll": "12px",
-                    "backgroundColor": "#FAFAFA",
-                    "cornerRadius": "8px"
-                },
-                # お住まい
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "📍 お住まい",
-                            "size": "sm",
-                            "color": "#999999",
-                            "weight": "bold"
-                        },
-                        {
-                            "type": "text",
-                            "text": f"{prefecture or '未設定'} {municipality or ''}",
-                            "size": "md",
-                            "color": "#333333",
-                            "wrap": True,
-                            "margin": "sm"
-                        },
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "postback",
-                                "label": "変更",
-                                "data": "action=edit_address",
-                                "displayText": "お住まいを変更"
-                            },
-                            "style": "link",
-                            "height": "sm",
-                            "margin": "sm"
-                        }
-                    ],
-                    "paddingAll": "12px",
-                    "backgroundColor": "#FAFAFA",
-                    "cornerRadius": "8px",
-                    "margin": "md"
-                },
-                # 死亡日
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "📅 死亡日",
-                            "size": "sm",
-                            "color": "#999999",
-                            "weight": "bold"
-                        },
-                        {
-                            "type": "text",
-                            "text": death_date_str,
-                            "size": "md",
-                            "color": "#333333",
-                            "wrap": True,
-                            "margin": "sm"
-                        },
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "postback",
-                                "label": "変更",
-                                "data": "action=edit_death_date",
-                                "displayText": "死亡日を変更"
-                            },
-                            "style": "link",
-                            "height": "sm",
-                            "margin": "sm"
-                        }
-                    ],
-                    "paddingAll": "12px",
-                    "backgroundColor": "#FAFAFA",
-                    "cornerRadius": "8px",
-                    "margin": "md"
-                },
+                _profile_section(_RELATIONSHIP_SECTION, relationship or "未設定"),
+                _profile_section(_ADDRESS_SECTION, f"{prefecture or '未設定'} {municipality or ''}"),
+                _death_date_section(death_date_str),
                 # プラン情報を追加
                 get_plan_info_section(user_id),
-                # サブスクリプション管理（Issue #19対応）
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "💳 サブスクリプション",
-                            "size": "sm",
-                            "color": "#999999",
-                            "weight": "bold"
-                        },
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "postback",
-                                "label": "ステータスを確認",
-                                "data": "action=view_subscription_status",
-                                "displayText": "サブスクリプションステータスを確認"
-                            },
-                            "style": "link",
-                            "height": "sm",
-                            "margin": "sm"
-                        },
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "postback",
-                                "label": "解約手続き",
-                                "data": "action=cancel_subscription",
-                                "displayText": "サブスクリプションを解約"
-                            },
-                            "style": "link",
-                            "height": "sm",
-                            "margin": "sm",
-                            "color": "#FF6B6B"
-                        }
-                    ],
-                    "paddingAll": "12px",
-                    "backgroundColor": "#FAFAFA",
-                    "cornerRadius": "8px",
-                    "margin": "md"
-                },
-                # 注意書き
-                {
-                    "type": "box",
-                    "layout": "vertical",
-                    "contents": [
-                        {
-                            "type": "text",
-                            "text": "💡 死亡日を変更すると、タスクの期限も再計算されます。",
-                            "size": "xs",
-                            "color": "#999999",
-                            "wrap": True
-                        }
-                    ],
-                    "margin": "lg"
-                }
+                _SUBSCRIPTION_SECTION,
+                _SETTINGS_NOTICE
             ],
             "paddingAll": "20px"
         }
@@ -2,9 +2,12 @@
 無料/有料プラン制御ロジック
 Phase 1: タスク表示制限とプラン別機能制御
 """
-from typing import List, Dict, Any, Optional
+import logging
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 from subscription_manager import SubscriptionManager
 
+logger = logging.getLogger(__name__)
+
 
 class PlanController:
     """プラン別の機能制御"""
@@ -22,8 +25,8 @@ class PlanController:
     def filter_tasks_by_plan(
         self,
         user_id: str,
-        tasks: List[Dict[str, Any]]
-    ) -> List[Dict[str, Any]]:
+        tasks: Sequence[Sequence[Any]]
+    ) -> List[Sequence[Any]]:
         """
         ユーザーのプランに応じてタスクリストをフィルタリング
 
@@ -32,52 +35,49 @@ class PlanController:
 
         Args:
             user_id: ユーザーのUUID
-            tasks: タスクリスト
+            tasks: タスクの行のリスト [(id, title, due_date, status, priority, category, metadata), ...]
+                （SQLの結果の行をそのまま渡せる）
 
         Returns:
-            フィルタリング後のタスクリスト
+            フィルタリング後のタスクリスト（表示可能なタスクは渡された行をそのまま返す）
         """
         is_premium = self.subscription_manager.is_premium_user(user_id)
-        print(f"🎫 プラン確認: user_id={user_id}, is_premium={is_premium}, tasks_count={len(tasks)}")
+        logger.debug("🎫 プラン確認: user_id=%s, is_premium=%s, tasks_count=%s", user_id, is_premium, len(tasks))
 
         if is_premium:
             # 有料プラン: すべて表示
-            return tasks
+            return list(tasks)
 
         # 無料プラン: 2タスクのみ表示、残りはマスク
-        filtered_tasks = []
-
-        for idx, task in enumerate(tasks):
-            if idx < self.FREE_PLAN_TASK_LIMIT:
-                # 最初の2タスクはそのまま表示
-                filtered_tasks.append(task)
-            else:
-                # 3タスク目以降はマスク表示
-                masked_task = self._mask_task(task)
-                filtered_tasks.append(masked_task)
+        limit = self.FREE_PLAN_TASK_LIMIT
+        return [
+            *tasks[:limit],
+            *(self._mask_task(task) for task in tasks[limit:])
+        ]
 
-        return filtered_tasks
-
-    def _mask_task(self, task: Dict[str, Any]) -> Dict[str, Any]:
+    def _mask_task(self, task: Sequence[Any]) -> Tuple[Any, ...]:
         """
         タスク情報をマスク表示用に変換
 
         Args:
-            task: タスク情報
+            task: タスクの行 (id, title, due_date, status, priority, category, metadata)
 
         Returns:
-            マスクされたタスク情報
-        """
-        return {
-            **task,
-            "title": "🔒 有料プランで閲覧可能",
-            "description": "このタスクを見るには有料プランへのアップグレードが必要です",
-            "is_masked": True,
-            "metadata": {
+            タイトルとメタデータをマスクしたタスクの行
+        """
+        task_id, _, due_date, status, priority, category, _ = task
+        return (
+            task_id,
+            "🔒 有料プランで閲覧可能",
+            due_date,
+            status,
+            priority,
+            category,
+            {
                 "masked": True,
                 "upgrade_required": True
             }
-        }
+        )
 
     def can_add_custom_task(self, user_id: str) -> bool:
         """
@@ -3,12 +3,15 @@ Stripe連携とサブスクリプション管理
 Phase 1: 課金システム実装
 """
 import os
-from typing import Optional, Dict, Any
+import logging
+from typing import Optional, Dict, Any, Tuple
 from datetime import datetime, timezone
 import stripe
 import sqlalchemy
 from sqlalchemy import text
 
+logger = logging.getLogger(__name__)
+
 
 class SubscriptionManager:
     """Stripeサブスクリプション管理"""
@@ -83,10 +86,30 @@ class SubscriptionManager:
             有料プランならTrue、無料プランまたはサブスクなしならFalse
         """
         subscription = self.get_user_subscription(user_id)
-        print(f"💳 サブスクリプション取得: user_id={user_id}, subscription={subscription}")
+        return self._is_premium_subscription(user_id, subscription)
+
+    def get_status_bundle(self, user_id: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """
+        有料プランかどうかとサブスクリプション情報をまとめて取得
+
+        is_premium_user と get_user_subscription を続けて呼ぶと
+        サブスクリプションを2回取得するため、両方が必要な場合はこちらを使う
+
+        Args:
+            user_id: ユーザーのUUID
+
+        Returns:
+            (有料プランならTrue, サブスクリプション情報の辞書またはNone)
+        """
+        subscription = self.get_user_subscription(user_id)
+        return self._is_premium_subscription(user_id, subscription), subscription
+
+    def _is_premium_subscription(self, user_id: str, subscription: Optional[Dict[str, Any]]) -> bool:
+        """取得済みのサブスクリプション情報から有料プランかどうかを判定"""
+        logger.debug("💳 サブスクリプション取得: user_id=%s, subscription=%s", user_id, subscription)
 
         if not subscription:
-            print(f"❌ サブスクリプションなし → 無料プラン")
+            logger.debug("❌ サブスクリプションなし → 無料プラン")
             return False
 
         # アクティブなベータ版または標準プランなら有料ユーザー
@@ -94,7 +117,7 @@ class SubscriptionManager:
         is_paid_plan = subscription["plan_type"] in [self.PLAN_BETA, self.PLAN_STANDARD]
 
         result = is_active and is_paid_plan
-        print(f"✅ サブスクリプション判定: is_active={is_active}, is_paid_plan={is_paid_plan}, result={result}")
+        logger.debug("✅ サブスクリプション判定: is_active=%s, is_paid_plan=%s, result=%s", is_active, is_paid_plan, result)
         return result
 
     def create_checkout_session(
@@ -168,23 +191,23 @@ class SubscriptionManager:
         Args:
             session: Stripe Checkout Sessionオブジェクト
         """
-        print(f"🔍 handle_checkout_completed開始: session={session}")
+        logger.info("🔍 handle_checkout_completed開始: session=%s", session)
 
         user_id = session["metadata"]["user_id"]
         customer_id = session["customer"]
         subscription_id = session["subscription"]
 
-        print(f"📝 ユーザー情報: user_id={user_id}, customer_id={customer_id}, subscription_id={subscription_id}")
+        logger.info("📝 ユーザー情報: user_id=%s, customer_id=%s, subscription_id=%s", user_id, customer_id, subscription_id)
 
         # サブスクリプション情報を取得
-        print(f"🔄 Stripeからサブスクリプション情報を取得中...")
+        logger.info("🔄 Stripeからサブスクリプション情報を取得中...")
         subscription = stripe.Subscription.retrieve(subscription_id)
-        print(f"✅ サブスクリプション取得完了: current_period_start={subscription['current_period_start']}")
+        logger.info("✅ サブスクリプション取得完了: current_period_start=%s", subscription['current_period_start'])
 
-        print(f"🗄️ データベース接続開始...")
+        logger.info("🗄️ データベース接続開始...")
         with self.engine.connect() as conn:
             with conn.begin():
-                print(f"🔄 既存サブスクリプションを無効化中...")
+                logger.info("🔄 既存サブスクリプションを無効化中...")
                 # 既存のサブスクリプションを無効化
                 result = conn.execute(
                     text("""
@@ -200,9 +223,9 @@ class SubscriptionManager:
                         "expired_status": self.STATUS_EXPIRED
                     }
                 )
-                print(f"✅ 既存サブスクリプション無効化完了: 更新件数={result.rowcount}")
+                logger.info("✅ 既存サブスクリプション無効化完了: 更新件数=%s", result.rowcount)
 
-                print(f"🆕 新しいサブスクリプションを作成中...")
+                logger.info("🆕 新しいサブスクリプションを作成中...")
                 # 新しいサブスクリプションを作成
                 result = conn.execute(
                     text("""
@@ -226,9 +249,9 @@ class SubscriptionManager:
                         "subscription_id": subscription_id
                     }
                 )
-                print(f"✅ サブスクリプション作成完了")
+                logger.info("✅ サブスクリプション作成完了")
 
-        print(f"🎉 handle_checkout_completed処理完了！")
+        logger.info("🎉 handle_checkout_completed処理完了！")
 
     def handle_subscription_deleted(self, subscription: Dict[str, Any]) -> None:
         """
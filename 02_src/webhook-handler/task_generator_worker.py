@@ -26,6 +26,7 @@ REGION = os.environ.get('GCP_REGION', 'asia-northeast1')
 
 # グローバル変数（遅延初期化）
 _configuration = None
+_messaging_api = None
 _engine = None
 _connector = None
 
@@ -49,6 +50,16 @@ def get_line_configuration():
     return _configuration
 
 
+def get_messaging_api():
+    """LINE MessagingApiを取得（遅延初期化、HTTPコネクションを呼び出し間で再利用）"""
+    global _messaging_api
+
+    if _messaging_api is None:
+        _messaging_api = MessagingApi(ApiClient(get_line_configuration()))
+
+    return _messaging_api
+
+
 def get_db_engine():
     """データベースエンジンを取得（遅延初期化）"""
     global _engine, _connector
@@ -137,16 +148,13 @@ def generate_tasks_worker(request: Request):
         summary_message = get_task_summary_message(tasks, municipality)
 
         # LINE Push APIで通知
-        configuration = get_line_configuration()
-        with ApiClient(configuration) as api_client:
-            line_bot_api = MessagingApi(api_client)
-
-            line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text=summary_message)]
-                )
+        line_bot_api = get_messaging_api()
+        line_bot_api.push_message(
+            PushMessageRequest(
+                to=user_id,
+                messages=[TextMessage(text=summary_message)]
             )
+        )
 
         print(f"📤 Push通知送信完了: user_id={user_id}")
 
@@ -163,17 +171,15 @@ def generate_tasks_worker(request: Request):
 
         # エラー時もユーザーに通知
         try:
-            configuration = get_line_configuration()
-            with ApiClient(configuration) as api_client:
-                line_bot_api = MessagingApi(api_client)
-                line_bot_api.push_message(
-                    PushMessageRequest(
-                        to=user_id,
-                        messages=[TextMessage(
-                            text="⚠️ タスク生成中にエラーが発生しました。\n\nお手数ですが、しばらく時間をおいて再度プロフィール登録をお試しください。"
-                        )]
-                    )
+            line_bot_api = get_messaging_api()
+            line_bot_api.push_message(
+                PushMessageRequest(
+                    to=user_id,
+                    messages=[TextMessage(
+                        text="⚠️ タスク生成中にエラーが発生しました。\n\nお手数ですが、しばらく時間をおいて再度プロフィール登録をお試しください。"
+                    )]
                 )
+            )
         except:
             pass
 